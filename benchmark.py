@@ -0,0 +1,515 @@
+'''
+Benchmarks for the randomizer.
+
+Everything runs against a synthetic rom laid out from the table specs that
+randomtools reads, so the game itself is not needed. Each run times
+every randomizer phase over a few seeds plus some hot functions on their
+own, appends the results to a JSON lines file together with the current
+git commit, and prints them next to the previous stored run.
+
+Usage: python benchmark.py [seeds] [resultsfile]
+'''
+from random import Random
+from timeit import default_timer
+from contextlib import contextmanager
+from tempfile import mkdtemp
+from shutil import rmtree, copyfile
+from os import path, devnull
+from subprocess import check_output
+from randomtools.tablereader import TABLE_SPECS
+from randomtools.utils import rewrite_snes_checksum
+from time import time
+import platform
+import json
+import sys
+
+import randomizer
+from randomizer import (
+    RandomizerSession, PhaseProfiler, ItemObject, MonsterObject,
+    LevelUpObject, generate_name, load_name_generator, write_tables,
+    OTHELLO_PRIZES, LEARN_POINTER, SHOP_POINTER, random)
+
+
+RESULTS_FILE = "benchmark_results.jsonl"
+HERE = path.dirname(path.abspath(__file__))
+PARSE_SCRIPT = """
+from timeit import default_timer
+from randomizer import RandomizerSession
+start = default_timer()
+RandomizerSession(%r)
+print default_timer() - start
+"""
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+# rom sizes whose checksums are checked, one not a power of two
+CHECKSUM_SIZES = [0x200000, 0x280000]
+# where the records of pointed tables go
+POINTED_DATA = {"Unknown2Object": 0x31000, "UnknownObject": 0x31100}
+WEAPON_TYPES = [(0x05, "DR"), (0x8a, "SD"), (0x8b, "DR"), (0x8c, "RP"),
+                (0x8e, "BW"), (0x8f, "KN"), (0x90, "ST"), (0x91, "RG"),
+                (0x92, "WP"), (0x97, "DR")]
+ARMOR_TYPES = [(0x94, "AR"), (0x94, "RB"), (0x94, "ML"), (0x94, "CL"),
+               (0x95, "CL")]
+DRAGON_ITEMS = [0x7b, 0xdd, 0xee, 0xf4]
+KEY_ITEM = 0x57
+
+
+class SyntheticRom(object):
+    '''
+    A fake rom with every table in TABLE_SPECS at its listed address.
+    Fields are filled with values plausible enough for all of the
+    randomizer's phases to run; anything not set explicitly is zero.
+    '''
+
+    def __init__(self, seed=0, size=0x200000):
+        self.random = Random(seed)
+        self.data = bytearray(size)
+
+    def write(self, address, data):
+        self.data[address:address+len(data)] = data
+        return address + len(data)
+
+    def encode(self, objname, values):
+        data = bytearray()
+        for name, size, other in TABLE_SPECS[objname].attributes:
+            value = values.get(name, 0)
+            if other == "str":
+                value = bytearray(value)
+                assert len(value) <= size
+                data += value + bytearray(size - len(value))
+            elif other == "list":
+                if not isinstance(size, int):
+                    number, numbytes = map(int, size.split("x"))
+                elif size == 0:
+                    number, numbytes = len(value), 1
+                else:
+                    number, numbytes = size, 1
+                value = list(value) if value else [0] * number
+                assert len(value) == number
+                for v in value:
+                    data += self.encode_int(v, numbytes)
+            else:
+                data += self.encode_int(value, size)
+        return data
+
+    def encode_int(self, value, length):
+        return bytearray([(value >> (8*i)) & 0xFF for i in xrange(length)])
+
+    def write_table(self, objname, records):
+        specs = TABLE_SPECS[objname]
+        address = specs.pointer
+        if specs.grouped:
+            assert sum(map(len, records)) == specs.count
+        else:
+            assert len(records) == specs.count
+        if specs.grouped:
+            for group in records:
+                address = self.write(address, bytearray([len(group)]))
+                for values in group:
+                    address = self.write(address,
+                                         self.encode(objname, values))
+        elif specs.pointed:
+            point1, size = specs.pointed
+            subpointer = POINTED_DATA[objname]
+            for values in records:
+                address = self.write(address, self.encode_int(
+                    subpointer - point1, size))
+                subpointer = self.write(subpointer,
+                                        self.encode(objname, values))
+        elif specs.point1:
+            point1, size = specs.point1
+            subpointer = point1
+            for values in records + [None]:
+                address = self.write(address, self.encode_int(
+                    subpointer - point1, size))
+                if values is not None:
+                    subpointer = self.write(subpointer,
+                                            self.encode(objname, values))
+        else:
+            for values in records:
+                address = self.write(address, self.encode(objname, values))
+
+    def name(self, length):
+        r = self.random
+        return r.choice(LETTERS.upper()) + "".join(
+            [r.choice(LETTERS) for _ in xrange(length-1)])
+
+    def randbytes(self, number, mask=0xFF):
+        return [self.random.randint(0, 0xFF) & mask for _ in xrange(number)]
+
+    def build(self):
+        r = self.random
+        self.build_items()
+        good = range(1, 0x3e) + range(0x5c, 0x100)
+
+        self.write_table("DropObject", [
+            {"common": r.choice(good), "rare": r.choice(good)}
+            for _ in xrange(64)])
+        self.write_table("ChestObject", [
+            {"contents": r.choice(good)} for _ in xrange(160)])
+        self.write_table("DresserObject", [
+            [{"x": r.randint(0, 63), "y": r.randint(0, 63),
+              "contents": r.choice(good), "address": r.randint(0, 40)}
+             for _ in xrange(6)] for _ in xrange(31)])
+
+        self.build_monsters()
+
+        pointer = SHOP_POINTER
+        for _ in xrange(34):
+            pointer = self.write(pointer, bytearray(r.sample(good, 6) + [0]))
+
+        self.build_characters()
+
+        self.write_table("RecipeObject", [
+            {"score": score} for score in
+            r.sample(range(1, 200), 40) + ([0] * 16)])
+        self.write_table("Unknown2Object", [
+            {"unk_pointer": (POINTED_DATA["UnknownObject"] + 64*i) & 0xFFFF}
+            for i in xrange(42)])
+        self.write_table("UnknownObject", [
+            {"unknown": r.randint(0, 0xFFFFFFFF)} for _ in xrange(664)])
+        self.write_table("ComboObject", [
+            {"fusions": [r.randint(0, 158) for _ in xrange(21)]}
+            for _ in xrange(8)])
+        self.write_table("FusionObject", [
+            dict(zip(["Off", "Def", "Vig", "Wis", "Luk", "mAP"],
+                     self.randbytes(6)) + [("character", 2*r.randint(0, 7))])
+            for _ in xrange(158)])
+
+        self.write(0xFFC0, bytearray("BREATH OF FIRE 2    "))
+        self.write(0xFFDC, bytearray([0xFF, 0xFF, 0, 0]))
+        # an expanded rom, with data past the game's 2MB
+        if len(self.data) > 0x200000:
+            self.write(0x200000, bytearray(
+                self.randbytes(len(self.data) - 0x200000)))
+        return self.data
+
+    def build_items(self):
+        r = self.random
+        items = []
+        for i in xrange(256):
+            item = {}
+            if i == 0:
+                pass
+            elif i < 0x3f:
+                item = {"name": self.name(6), "price": r.randint(10, 3000)}
+            elif i <= 0x50:
+                item = {"name": self.name(6) + "BR",
+                        "price": r.randint(100, 9000),
+                        "equippable": r.randint(1, 255),
+                        "power": r.randint(1, 30)}
+            elif i <= 0x5b:
+                item = {"name": self.name(6), "price": r.randint(10, 500),
+                        "itemtype": 0xf7}
+                if i == KEY_ITEM:
+                    item["misc1"] = 0x80
+            elif i in DRAGON_ITEMS:
+                item = {"name": self.name(6) + "DR", "itemtype": 0x8d,
+                        "price": r.randint(2, 9000), "equippable": 0x80,
+                        "power": r.randint(1, 99)}
+            else:
+                if i < 0xa0:
+                    itemtype, suffix = WEAPON_TYPES[i % len(WEAPON_TYPES)]
+                elif i < 0xe0:
+                    itemtype, suffix = ARMOR_TYPES[i % len(ARMOR_TYPES)]
+                elif i < 0xf0:
+                    itemtype, suffix = 0x93, r.choice(["HT", "Mask"])
+                else:
+                    itemtype, suffix = 0x96, r.choice(["SH", "GL"])
+                item = {"name": self.name(8 - len(suffix)) + suffix,
+                        "itemtype": itemtype,
+                        "price": r.randint(20, 20000),
+                        "power": r.randint(1, 120),
+                        "equippable": r.choice([0xFF, r.randint(1, 254),
+                                                r.randint(1, 254)])}
+                if r.randint(1, 20) == 20:
+                    item["misc1"] = 0x80
+            item["weight"] = 1
+            items.append(item)
+        self.write_table("ItemObject", items)
+
+        for address, types in OTHELLO_PRIZES:
+            suffix = types[0] if isinstance(types, list) else types
+            candidates = [i for (i, item) in enumerate(items)
+                          if item.get("name", "").endswith(suffix)]
+            self.write(address, bytearray([r.choice(candidates)]))
+
+    def build_monsters(self):
+        r = self.random
+        monsters = []
+        for i in xrange(200):
+            monsters.append({
+                "name": self.name(r.randint(3, 8)) if i % 17 else "",
+                "hp": r.randint(1, 9000), "ap": r.randint(0, 300),
+                "luck": r.randint(1, 200), "atp": r.randint(1, 400),
+                "dfp": r.randint(1, 400), "agl": r.randint(1, 400),
+                "ms": r.randint(0, 7), "xp": r.randint(1, 3000),
+                "gp": r.randint(1, 3000), "treasure_set": r.randint(0, 63),
+                "type": r.randint(0, 5), "treasure_class": r.randint(0, 6),
+                "ai": bytearray(self.randbytes(5))})
+        self.write_table("MonsterObject", monsters)
+
+        # every tenth monster never shows up in a formation, as a boss
+        regular = [m for m in xrange(200) if m % 10]
+        formations = []
+        for _ in xrange(256):
+            number = r.randint(1, 5)
+            kinds = r.sample(regular, r.randint(1, min(number, 3)))
+            formations.append({
+                "mould": r.randint(0, 9), "ff": 0xFF,
+                "enemy_ids": ([r.choice(kinds) for _ in xrange(number)]
+                              + [0xFF] * (5 - number))})
+        self.write_table("FormationObject", formations)
+        self.write_table("FormDataObject", [
+            {"data": self.randbytes(7)} for _ in xrange(255)])
+        self.write_table("ZoneObject", [
+            {"formation_indexes": self.randbytes(8)} for _ in xrange(64)])
+
+        palettes = TABLE_SPECS["PaletteObject"]
+        self.write_table("GraphicsObject", [
+            {"palette_address": ((palettes.pointer
+                                  + 32*r.randint(0, palettes.count-1))
+                                 & 0xFFFF) if i % 13 else 0,
+             "unknown": r.randint(0, 0xFFFF)} for i in xrange(200)])
+        self.write_table("PaletteObject", [
+            {"colors": [r.randint(0, 0x7FFF) for _ in xrange(16)]}
+            for _ in xrange(palettes.count)])
+
+    def build_characters(self):
+        r = self.random
+        self.write_table("CharacterObject", [
+            {"name": self.name(4), "level": r.randint(1, 15),
+             "current_hp": 50, "max_hp": 50,
+             "current_ap": 20, "max_ap": 20,
+             "strength": r.randint(1, 20), "stamina": r.randint(1, 20),
+             "agility": r.randint(1, 20), "guts": r.randint(1, 20),
+             "wisdom": r.randint(1, 20), "luck": r.randint(1, 20)}
+            for _ in xrange(11)])
+        self.write_table("LevelUpObject", [
+            {"data": bytearray(self.randbytes(392, mask=0x37))}
+            for _ in xrange(9)])
+
+        spells = TABLE_SPECS["SpellObject"].count
+        self.write_table("SpellObject", [
+            {"name": self.name(6), "cost": r.randint(1, 30),
+             "element": 1 << r.randint(0, 7)} for _ in xrange(spells)])
+        usable = [i for i in xrange(spells)
+                  if i not in [0, 8, 9, 0x1e, 0x1f, 0x20]]
+        self.write_table("InitialObject", [
+            {"LDA": 0xa9, "value": r.choice(usable), "STA": 0x8f,
+             "addr": 0x5400 | (((i % 9) + 1) << 5) | (i / 9), "7e": 0x7e}
+            for i in xrange(36)])
+
+        pointer = LEARN_POINTER
+        subpointer = pointer + 18
+        for i in xrange(9):
+            self.write(pointer + 2*i,
+                       self.encode_int(subpointer - pointer, 2))
+            levels = sorted(r.sample(range(2, 60), 4))
+            for level, spell in zip(levels, r.sample(usable, 4)):
+                subpointer = self.write(subpointer,
+                                        bytearray([level, spell]))
+            subpointer = self.write(subpointer, bytearray([0]))
+
+
+def build_rom(filename, seed=0, size=0x200000):
+    f = open(filename, "wb")
+    f.write(SyntheticRom(seed, size).build())
+    f.close()
+
+
+@contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = open(devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def timed(function, repeat=5, setup=None):
+    best = None
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        function()
+        duration = default_timer() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle-1] + values[middle]) / 2.0
+
+
+def time_parse(sourcefile, repeat=3):
+    '''
+    Best time to load the rom in a fresh process, where no table has been
+    parsed yet, as in a single seed run.
+    '''
+    best = None
+    for _ in xrange(repeat):
+        output = check_output([sys.executable, "-c",
+                               PARSE_SCRIPT % path.abspath(sourcefile)],
+                              cwd=HERE)
+        duration = float(output.split()[-1])
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def run_phases(sourcefile, seeds):
+    parse = time_parse(sourcefile)
+    with quiet():
+        session = RandomizerSession(sourcefile)
+        reload = timed(lambda: RandomizerSession(sourcefile))
+        profiler = PhaseProfiler()
+        session.profiler = profiler
+        try:
+            for seed in seeds:
+                session.generate("", seed)
+        finally:
+            session.profiler = None
+
+    times = {}
+    for phase in profiler.phases:
+        times.setdefault(phase["name"], []).append(phase["time"])
+    results = dict((name, median(values)) for (name, values) in times.items())
+    results["parse"] = parse
+    results["reload"] = reload
+    results["seed"] = sum(results[name] for name in times)
+    return session, results
+
+
+def run_micro(session, workdir):
+    session.reset()
+    results = {}
+
+    def get_similar():
+        random.seed(0)
+        for i in ItemObject.every:
+            i.get_similar()
+            i.get_similar(same_kind=True)
+            i.get_similar(similar_kind=True)
+    results["get_similar"] = timed(get_similar)
+
+    def monster_rank():
+        for m in MonsterObject.every:
+            m.rank
+    results["monster_rank"] = timed(monster_rank)
+
+    def value_at_level():
+        for l in LevelUpObject.every:
+            for attr in sorted(LevelUpObject.maxdict):
+                for level in [10, 50, 99]:
+                    l.value_at_level(attr, level)
+    results["value_at_level"] = timed(value_at_level)
+
+    load_name_generator()
+
+    def names():
+        random.seed(0)
+        for _ in xrange(200):
+            generate_name(maxsize=8)
+    results["generate_name"] = timed(names)
+
+    outfile = path.join(workdir, "write.smc")
+
+    def modify():
+        session.reset()
+        for m in MonsterObject.every:
+            m.hp ^= 1
+        for i in ItemObject.every:
+            i.price ^= 1
+
+    def write():
+        write_tables(0, outfile)
+    with quiet():
+        results["write_tables_clean"] = timed(write, setup=session.reset)
+        results["write_tables"] = timed(write, setup=modify)
+    return results
+
+
+def check_checksums(workdir):
+    '''
+    Generates a seed from a rom of each size in CHECKSUM_SIZES and checks
+    the checksum the randomizer kept up to date against the one randomtools
+    computes from the whole output rom.
+    '''
+    for size in CHECKSUM_SIZES:
+        sourcefile = path.join(workdir, "checksum.smc")
+        build_rom(sourcefile, size=size)
+        with quiet():
+            outfile, _ = RandomizerSession(sourcefile).generate("", 1)
+        expected = path.join(workdir, "expected.smc")
+        copyfile(outfile, expected)
+        rewrite_snes_checksum(expected)
+        if open(outfile, "rb").read() != open(expected, "rb").read():
+            raise Exception("Wrong checksum for a %x byte rom." % size)
+
+
+def get_commit():
+    try:
+        return check_output(["git", "rev-parse", "--short", "HEAD"],
+                            cwd=HERE, stderr=open(devnull, "w")).strip()
+    except Exception:
+        return None
+
+
+def read_results(filename):
+    if not path.exists(filename):
+        return []
+    return [json.loads(line) for line in open(filename) if line.strip()]
+
+
+def report(result, previous=None):
+    print "commit %s, %s seeds" % (result["commit"], len(result["seeds"]))
+    for section in ["phases", "micro"]:
+        print
+        print section.upper()
+        for name, value in sorted(result[section].items()):
+            s = "  {0:20} {1:9.4f}s".format(name, value)
+            if previous is not None and name in previous.get(section, {}):
+                old = previous[section][name]
+                if old > 0:
+                    s += "  {0:+7.1f}% vs {1}".format(
+                        100 * (value - old) / old, previous["commit"])
+            print s
+
+
+def run_benchmarks(seeds, resultsfile=RESULTS_FILE):
+    workdir = mkdtemp()
+    try:
+        sourcefile = path.join(workdir, "synthetic.smc")
+        build_rom(sourcefile)
+        session, phases = run_phases(sourcefile, seeds)
+        micro = run_micro(session, workdir)
+        check_checksums(workdir)
+    finally:
+        rmtree(workdir)
+
+    result = {"commit": get_commit(), "time": int(time()),
+              "python": platform.python_version(),
+              "version": randomizer.VERSION, "seeds": seeds,
+              "phases": phases, "micro": micro}
+    previous = read_results(resultsfile)
+    report(result, previous[-1] if previous else None)
+    f = open(resultsfile, "a+")
+    f.write(json.dumps(result, sort_keys=True) + "\n")
+    f.close()
+    return result
+
+
+if __name__ == "__main__":
+    seeds = randomizer.parse_seeds(sys.argv[1]) if len(sys.argv) > 1 \
+        else range(1, 4)
+    resultsfile = sys.argv[2] if len(sys.argv) > 2 else RESULTS_FILE
+    run_benchmarks(seeds, resultsfile)
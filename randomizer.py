@@ -1,16 +1,30 @@
-from randomtools.tablereader import TableObject, set_global_table_filename
+from randomtools.tablereader import (
+    TableObject, set_global_table_filename, OBJECT_DICT, GRAND_OBJECT_DICT)
 from randomtools.utils import (
-    read_multi, write_multi, classproperty, mutate_normal,
-    hexstring, rewrite_snes_title, rewrite_snes_checksum,
-    get_snes_palette_transformer, generate_name,
+    write_multi, classproperty, mutate_normal,
+    hexstring, get_snes_palette_transformer, generate_name,
     utilrandom as random)
-from shutil import copyfile
-from os import path
-from sys import argv
+from multiprocessing import Pool, cpu_count, freeze_support
+from contextlib import contextmanager
+from array import array
+from copy import deepcopy
+from os import path, stat
+from sys import argv, modules, platform
 from time import time
 from math import log
+from bisect import bisect_left, bisect_right
+from operator import or_
+from struct import Struct
+import cProfile
+import heapq
+import json
 import string
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 try:
     from sys import _MEIPASS
@@ -21,43 +35,607 @@ except ImportError:
 spell_level_file = path.join(tblpath, "spell_level_table.txt")
 name_generator_file = path.join(tblpath, "generator.txt")
 
-g_learns = None
-g_shops = None
 TEST = False
 RANDOMIZE = True
 VERSION = 2
 ELEMENTS = ["fire", "water", "wind", "earth", "holy", "dark"]
 AFFINITIES = ["Off", "Def", "Vig", "Wis", "mAP"]
-DONE_AFFINITIES = []
 CHAOS_FUSIONS = [0x0, 0x2, 0x4, 0x6, 0x8, 0xa, 0xc, 0xe, 0x10, 0x12]
 SUPER_FUSIONS = [0x16, 0x18, 0x1a, 0x1c, 0x1e, 0x20, 0x22, 0x24, 0x26]
-difficulty = None
+OTHELLO_PRIZES = [(0x9220, ['SD', 'RP']),
+                  (0x9255, 'WP'),
+                  (0x9278, 'BW'),
+                  (0x929b, 'HT'),
+                  (0x95e1, 'DR'),
+                  (0x9616, 'ST'),
+                  (0x9639, ['AR', 'ML']),
+                  (0x965C, 'SH')]
+LEARN_POINTER = 0x5aa00
+SHOP_POINTER = 0x3fac0
+
+
+def read_little_endian(data):
+    value = 0
+    for i, byte in enumerate(data):
+        value |= byte << (i * 8)
+    return value
+
+
+def get_substrings(text):
+    return set([text[i:j] for i in xrange(len(text)+1)
+                for j in xrange(i, len(text)+1)])
+
+
+g_namegen_loaded = False
+
+
+def load_name_generator():
+    global g_namegen_loaded
+    if not g_namegen_loaded:
+        generate_name(namegen_table=name_generator_file)
+        g_namegen_loaded = True
 
 
 def set_difficulty(value):
-    global difficulty
     if not isinstance(value, float) and not isinstance(value, int):
         value = 1.0
-    difficulty = value
-    return difficulty
+    session.difficulty = value
+    return session.difficulty
 
 
-class ShamanCompat():
-    allshamans = {}
+class RomBuffer(object):
+    '''
+    In-memory image of the output rom. Every read and write made by the
+    randomizer goes through this buffer, which behaves enough like a file
+    for read_multi and write_multi. The image is written to disk once,
+    either whole by flush() or as an IPS patch against the source rom by
+    write_ips().
+    '''
+
+    def __init__(self, sourcefile):
+        f = open(sourcefile, 'rb')
+        self.source = f.read()
+        f.close()
+        self.cachefile = "%s.cache" % sourcefile
+        self.cachekey = [VERSION, len(self.source),
+                         stat(sourcefile).st_mtime]
+        self.data = bytearray(self.source)
+        self.written = []
+        self.position = 0
+        self.source_sum = None
+        self.sum_delta = 0
+
+    def reset(self):
+        self.data[:] = self.source
+        self.written = []
+        self.position = 0
+        self.sum_delta = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def seek(self, pointer, whence=0):
+        if whence == 1:
+            pointer += self.position
+        elif whence == 2:
+            pointer += len(self.data)
+        self.position = pointer
+
+    def tell(self):
+        return self.position
+
+    def read(self, length=None):
+        if length is None:
+            length = len(self.data) - self.position
+        data = str(self.data[self.position:self.position+length])
+        self.position += len(data)
+        return data
+
+    def write(self, data):
+        start, end = self.position, self.position + len(data)
+        assert end <= len(self.data)
+        old_sum = sum(self.data[start:end])
+        self.data[start:end] = data
+        self.sum_delta += sum(self.data[start:end]) - old_sum
+        self.written.append((start, end))
+        self.position = end
+
+    def close(self):
+        pass
+
+    def rewrite_snes_title(self, text, version):
+        while len(text) < 20:
+            text += ' '
+        if len(text) > 20:
+            text = text[:19] + "?"
+        self.seek(0xFFC0)
+        self.write(text)
+        self.seek(0xFFDB)
+        self.write(chr(version))
+
+    def get_source_sum(self):
+        '''
+        The byte sum of the source rom. It is kept in a ".cache" file next
+        to the rom and reused until the rom's size or modification time
+        changes, so a single seed run doesn't sum the whole rom again.
+        '''
+        if self.source_sum is not None:
+            return self.source_sum
+        try:
+            cache = json.load(open(self.cachefile))
+            if cache["key"] == self.cachekey:
+                self.source_sum = cache["sum"]
+                return self.source_sum
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        self.source_sum = sum(bytearray(self.source))
+        try:
+            f = open(self.cachefile, 'w')
+            json.dump({"key": self.cachekey, "sum": self.source_sum}, f)
+            f.close()
+        except IOError:
+            pass
+        return self.source_sum
+
+    def rewrite_snes_checksum(self):
+        '''
+        The same checksum as randomtools' rewrite_snes_checksum, the sum of
+        every byte of the rom, kept up to date by write().
+        '''
+        self.seek(0xFFDC)
+        write_multi(self, 0xFFFF, length=2)
+        write_multi(self, 0x0000, length=2)
+        checksum = (self.get_source_sum() + self.sum_delta) & 0xFFFF
+        self.seek(0xFFDC)
+        write_multi(self, checksum ^ 0xFFFF, length=2)
+        write_multi(self, checksum, length=2)
+
+    def get_changed_ranges(self, maxgap=5):
+        written = []
+        for start, end in sorted(self.written):
+            if written and start <= written[-1][1]:
+                written[-1] = (written[-1][0], max(end, written[-1][1]))
+            else:
+                written.append((start, end))
+
+        changed = []
+        source, data = self.source, self.data
+        for start, end in written:
+            i = start
+            while i < end:
+                if data[i] == ord(source[i]):
+                    i += 1
+                    continue
+                j = i + 1
+                while j < end and data[j] != ord(source[j]):
+                    j += 1
+                if changed and i - changed[-1][1] <= maxgap:
+                    changed[-1] = (changed[-1][0], j)
+                else:
+                    changed.append((i, j))
+                i = j
+        return changed
+
+    def flush(self, filename):
+        f = open(filename, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def write_ips(self, filename):
+        if len(self.data) > 0x1000000:
+            raise Exception("Rom is too large for an IPS patch.")
+        f = open(filename, 'wb')
+        f.write("PATCH")
+        for start, end in self.get_changed_ranges():
+            while start < end:
+                if start == 0x454f46:
+                    # an offset of "EOF" would end the patch early
+                    start -= 1
+                size = min(end - start, 0xFFFF)
+                f.write(chr(start >> 16) + chr((start >> 8) & 0xFF)
+                        + chr(start & 0xFF))
+                f.write(chr(size >> 8) + chr(size & 0xFF))
+                f.write(self.data[start:start+size])
+                start += size
+        f.write("EOF")
+        f.close()
+
+
+class TableCodec(object):
+    '''
+    A table schema compiled to struct formats, so that a whole record is
+    read or written in one call. Ints of a size struct has no code for,
+    like the 3 byte exp, are packed as strings and converted by hand.
+    '''
+    intcodes = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.fields = {}
+        formats = []
+        offset = 0
+        for name, other, number, numbytes in layout:
+            if other == "str":
+                fmt = "%ds" % numbytes
+            elif numbytes in self.intcodes:
+                fmt = "%d%s" % (number, self.intcodes[numbytes])
+            else:
+                fmt = ("%ds" % numbytes) * number
+            self.fields[name] = (offset, Struct("<" + fmt), other, numbytes)
+            formats.append(fmt)
+            offset += number * numbytes
+        self.record = Struct("<" + "".join(formats))
+
+    def convert(self, values, other, numbytes):
+        if other != "str" and numbytes not in self.intcodes:
+            values = [read_little_endian(bytearray(v)) for v in values]
+        if other == "list":
+            return list(values)
+        return values[0]
+
+    def decode_field(self, data, pointer, name):
+        offset, field, other, numbytes = self.fields[name]
+        values = field.unpack_from(data, pointer + offset)
+        return self.convert(values, other, numbytes)
+
+    def decode(self, data, pointer):
+        values = self.record.unpack_from(data, pointer)
+        decoded = []
+        for name, other, number, numbytes in self.layout:
+            if other == "str":
+                number = 1
+            decoded.append((name, self.convert(values[:number], other,
+                                               numbytes)))
+            values = values[number:]
+        return decoded
+
+    def encode(self, obj):
+        values = []
+        for name, other, number, numbytes in self.layout:
+            value = getattr(obj, name)
+            if other == "str":
+                assert len(value) == numbytes
+                values.append(value)
+                continue
+            if other != "list":
+                value = [value]
+            assert len(value) == number
+            for v in value:
+                assert v >= 0
+                if numbytes not in self.intcodes:
+                    if v >> (numbytes * 8):
+                        raise Exception("Value length mismatch.")
+                    v = "".join([chr((v >> (i * 8)) & 0xFF)
+                                 for i in xrange(numbytes)])
+                values.append(v)
+        return self.record.pack(*values)
+
+
+class TableField(object):
+    '''
+    Field of a table record that is decoded from the source rom the first
+    time it is read, and from then on is an ordinary instance attribute.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.decode_field(self.name)
+        obj.__dict__[self.name] = value
+        return value
+
+
+class TableColumn(object):
+    '''
+    Int field of a columnar table. The values of every record are kept in
+    one typed array owned by the session rather than in instance dicts,
+    which is decoded from the source rom the first time the field is used.
+    Floats are stored truncated to int, as the rom encoding would write them.
+    '''
+    wide = [c for c in "IL" if array(c).itemsize >= 4][0]
+    typecodes = {1: "B", 2: "H", 3: wide, 4: wide}
+
+    def __init__(self, objtype, name, size):
+        self.name = name
+        self.objtype = objtype
+        self.key = (objtype.__name__, name)
+        self.typecode = self.typecodes[size]
+
+    def get_column(self):
+        column = session.columns.get(self.key)
+        if column is None:
+            column = array(self.typecode, [o.decode_field(self.name)
+                                           for o in self.objtype.every])
+            session.columns[self.key] = column
+        return column
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            return session.columns[self.key][obj.index]
+        except KeyError:
+            pass
+        except IndexError:
+            raise AttributeError(self.name)
+        return self.get_column()[obj.index]
+
+    def __set__(self, obj, value):
+        column = self.get_column()
+        if obj.index >= len(column):
+            column.extend([0] * (obj.index + 1 - len(column)))
+        column[obj.index] = int(value)
+
+
+class RankedIndex(object):
+    '''
+    The records of a table in (rank, index) order, with each record's rank
+    cached. Assigning a rank attribute only marks the record stale, and
+    stale records are moved to their new places with bisect the next time
+    the order is read.
+    '''
+
+    def __init__(self, objs):
+        keyed = sorted([((o.rank, o.index), o) for o in objs],
+                       key=lambda keyed: keyed[0])
+        self.keys = [key for (key, _) in keyed]
+        self.objs = [o for (_, o) in keyed]
+        self.ranks = dict([(index, rank) for (rank, index) in self.keys])
+        self.stale = {}
+        self.ordered = None
+        self.positions = None
+        self.derived = {}
+
+    def invalidate(self, obj):
+        self.stale[obj.index] = obj
+        self.derived = {}
+
+    def update(self):
+        for index, obj in sorted(self.stale.items()):
+            i = bisect_left(self.keys, (self.ranks[index], index))
+            del self.keys[i]
+            del self.objs[i]
+            key = (obj.rank, index)
+            i = bisect_left(self.keys, key)
+            self.keys.insert(i, key)
+            self.objs.insert(i, obj)
+            self.ranks[index] = key[0]
+        self.stale = {}
+        self.ordered = tuple(self.objs)
+        self.positions = dict([(o.index, n)
+                               for (n, o) in enumerate(self.objs)])
+
+    def get_ranked(self):
+        if self.stale or self.ordered is None:
+            self.update()
+        return self.ordered
+
+    def get_rank(self, obj):
+        self.get_ranked()
+        return self.ranks[obj.index]
+
+    def get_position(self, obj):
+        self.get_ranked()
+        return self.positions[obj.index]
+
+
+class RomTableObject(TableObject):
+    '''
+    Table object that reads and writes its fields through the rom buffer
+    instead of reopening the rom file for every record.
+    '''
+    rank_attrs = None
+    lazy = True
+    columnar = False
+    column_fields = []
+    codecs = None
+
+    def __setattr__(self, attr, value):
+        if self.rank_attrs and attr in self.rank_attrs:
+            index = session.ranked_cache.get(type(self))
+            if index is not None and getattr(self, attr, None) != value:
+                index.invalidate(self)
+        self.__dict__.setdefault("dirty_fields", set()).add(attr)
+        super(RomTableObject, self).__setattr__(attr, value)
+
+    def mark_clean(self):
+        self.__dict__["dirty_fields"] = set()
+
+    def is_touched(self):
+        '''
+        Whether any field has been assigned, or a list field decoded that
+        could have been changed in place. Untouched records can't be dirty.
+        '''
+        if self.__dict__.get("dirty_fields"):
+            return True
+        return any([isinstance(self.__dict__.get(name), list)
+                    for name in self.cached_fields])
+
+    def get_rom_range(self):
+        if self.pointer is None:
+            return None
+        return self.pointer, self.pointer + self.get_codec().record.size
+
+    def get_dirty_fields(self):
+        '''
+        Fields that no longer match the source rom. Assigned fields are
+        marked by __setattr__; list fields are compared as well, since they
+        are often modified in place.
+        '''
+        if not self.is_touched():
+            return []
+        original = session.originals.get((type(self), self.index), {})
+        marked = self.__dict__.get("dirty_fields", ())
+        dirty = []
+        for name in self.cached_fields:
+            if name in marked or isinstance(self.__dict__.get(name), list):
+                if name in original:
+                    old = original[name]
+                else:
+                    old = self.decode_field(name)
+                if getattr(self, name) != old:
+                    dirty.append(name)
+        return dirty
+
+    @classproperty
+    def ranked(cls):
+        if not cls.rank_attrs:
+            return sorted(cls.every, key=lambda c: (c.rank, c.index))
+        return cls.get_ranked_index().get_ranked()
+
+    @classmethod
+    def get_ranked_index(cls):
+        if cls not in session.ranked_cache:
+            session.ranked_cache[cls] = RankedIndex(cls.every)
+        return session.ranked_cache[cls]
+
+    def get_rank_position(self):
+        return self.get_ranked_index().get_position(self)
+
+    @classmethod
+    def install_fields(cls):
+        cls.codecs = {}
+        layout = cls.get_layout()
+        if layout is not None:
+            cls.codecs[None] = TableCodec(layout)
+        cls.column_fields = []
+        for name, size, other in cls.specs.attributes:
+            if (cls.columnar and other in [None, "int"]
+                    and size in TableColumn.typecodes):
+                setattr(cls, name, TableColumn(cls, name, size))
+                cls.column_fields.append(name)
+            else:
+                setattr(cls, name, TableField(name))
+
+    @classmethod
+    def get_column(cls, attr):
+        if attr in cls.column_fields:
+            return cls.__dict__[attr].get_column()
+        return [getattr(o, attr) for o in cls.every]
+
+    @classmethod
+    def get_columns(cls):
+        columns = {}
+        for name in cls.column_fields:
+            key = (cls.__name__, name)
+            if key in session.columns:
+                columns[key] = session.columns[key]
+        return columns
+
+    @classmethod
+    def get_pointer_index(cls, attr="pointer", mask=None):
+        '''
+        Index of every object by the value of `attr` (optionally masked),
+        as a dict of exact matches and as a sorted list for range queries.
+        Built once per session.
+        '''
+        key = (cls, attr, mask)
+        if key not in session.pointer_indexes:
+            def get_value(o):
+                value = getattr(o, attr)
+                return value if mask is None else value & mask
+            exact = {}
+            for o in cls.every:
+                exact.setdefault(get_value(o), []).append(o)
+            ordered = sorted(cls.every, key=get_value)
+            values = map(get_value, ordered)
+            session.pointer_indexes[key] = exact, values, ordered
+        return session.pointer_indexes[key]
+
+    @classmethod
+    def find_by_pointer(cls, value, attr="pointer", mask=None):
+        exact, _, _ = cls.get_pointer_index(attr, mask)
+        return list(exact.get(value, []))
+
+    @classmethod
+    def find_by_pointer_floor(cls, value, attr="pointer", mask=None):
+        '''
+        The object with the greatest `attr` that is not above `value`,
+        preferring the earliest object on ties.
+        '''
+        _, values, ordered = cls.get_pointer_index(attr, mask)
+        i = bisect_right(values, value)
+        if i == 0:
+            return None
+        return ordered[bisect_left(values, values[i-1])]
+
+    @classproperty
+    def cached_fields(cls):
+        return [name for (name, _, _) in cls.specs.attributes]
+
+    @classmethod
+    def get_layout(cls, variable_size=None):
+        layout = []
+        for name, size, other in cls.specs.attributes:
+            if other == "list":
+                if isinstance(size, int):
+                    number, numbytes = size, 1
+                else:
+                    number, numbytes = tuple(map(int, size.split('x')))
+                if number == 0:
+                    if variable_size is None:
+                        return None
+                    number = variable_size
+            else:
+                number, numbytes = 1, size
+            layout.append((name, other or "int", number, numbytes))
+        return layout
+
+    def get_codec(self):
+        '''
+        Fixed size tables are compiled once when the module is imported;
+        tables with a variable length list get a codec per record size.
+        '''
+        codecs = type(self).codecs
+        if None in codecs:
+            return codecs[None]
+        if self.variable_size not in codecs:
+            layout = self.get_layout(self.variable_size)
+            codecs[self.variable_size] = TableCodec(layout)
+        return codecs[self.variable_size]
+
+    def decode_field(self, name):
+        if self.pointer is None:
+            raise AttributeError(name)
+        return self.get_codec().decode_field(session.rom.source,
+                                             self.pointer, name)
+
+    def read_data(self, filename=None, pointer=None):
+        if pointer is None:
+            pointer = self.pointer
+        if pointer is None:
+            return
+        if pointer == self.pointer and self.lazy:
+            return
+
+        for name, value in self.get_codec().decode(session.rom.data, pointer):
+            setattr(self, name, value)
+
+    def write_data(self, filename=None, pointer=None):
+        if pointer is None:
+            pointer = self.pointer
+        if pointer is None:
+            return
+
+        session.rom.seek(pointer)
+        session.rom.write(self.get_codec().encode(self))
+
 
+class ShamanCompat():
     def __init__(self, element):
-        assert element not in self.allshamans
-        self.allshamans[element] = self
         self.element = element
         self.compatibility = {}
 
     @classmethod
     def get(cls, element):
-        return cls.allshamans[element]
+        return session.shamans[element]
 
     @classproperty
     def all_elements(cls):
-        return [cls.allshamans[key] for key in ELEMENTS]
+        return [session.shamans[key] for key in ELEMENTS]
 
     def generate_compatibility(self):
         for element in ELEMENTS:
@@ -79,9 +657,10 @@ class ShamanCompat():
         self.affinities = list(AFFINITIES)
         while True:
             random.shuffle(self.affinities)
-            if (len(DONE_AFFINITIES) >= 5
-                    or self.affinities[0] not in DONE_AFFINITIES):
-                DONE_AFFINITIES.append(self.affinities[0])
+            done_affinities = session.done_affinities
+            if (len(done_affinities) >= 5
+                    or self.affinities[0] not in done_affinities):
+                done_affinities.append(self.affinities[0])
                 break
 
     def get_compatibility(self, other):
@@ -117,11 +696,22 @@ class ShamanCompat():
         return s.strip()
 
 
-for e in ELEMENTS:
-    ShamanCompat(e)
+def get_pair_indexes(combos, shamans):
+    '''
+    Combo index for every shaman pair, by element name or shaman index.
+    '''
+    pair_indexes = {}
+    for key, i in combos.items():
+        if isinstance(key, int) or key[0] is None:
+            continue
+        a, b = key
+        for x in [a, shamans[a]]:
+            for y in [b] if b is None else [b, shamans[b]]:
+                pair_indexes[x, y] = i
+    return pair_indexes
 
 
-class ComboObject(TableObject):
+class ComboObject(RomTableObject):
     elements = ELEMENTS
     shamans = list(enumerate(elements))
     shamans = dict(shamans + [(b, a) for (a, b) in shamans])
@@ -134,6 +724,7 @@ class ComboObject(TableObject):
     combos = (combos + [((a, b), i) for (i, (a, b)) in combos]
               + [((b, a), i) for (i, (a, b)) in combos])
     combos = dict(combos)
+    pair_indexes = get_pair_indexes(combos, shamans)
 
     def nullify(self, i):
         self.nullified.append(i)
@@ -161,6 +752,7 @@ class ComboObject(TableObject):
     def get_boosts(self, i):
         if not hasattr(self, "boostdict"):
             self.boostdict = {}
+            self.boostkinds = {}
         if i in self.boostdict:
             return self.boostdict[i]
         a, b = self.calculate_shamans(i)
@@ -183,6 +775,8 @@ class ComboObject(TableObject):
             elif (upper < 0.5 and ab_comp > 0.5
                     and ab_comp > random.triangular(upper, 1)):
                 unstable = True
+            if reverse or unstable:
+                self.boostkinds[i] = "reverse" if reverse else "unstable"
             b_comp = max(b_comp, a_comp * ab_comp)
             for affinity in AFFINITIES:
                 if unstable:
@@ -220,13 +814,7 @@ class ComboObject(TableObject):
     @classmethod
     def calculate_index(cls, a, b=None):
         assert a is not None
-        if isinstance(a, int):
-            a = cls.shamans[a]
-        if b is not None:
-            if isinstance(b, int):
-                b = cls.shamans[b]
-            (a, b) = tuple(sorted([a, b], key=lambda c: cls.shamans[c]))
-        return cls.combos[a, b]
+        return cls.pair_indexes[a, b]
 
     @classmethod
     def calculate_shamans(cls, i):
@@ -274,17 +862,23 @@ class ComboObject(TableObject):
         if len(shamans) == 1:
             harmony = harmony / 4
             dischord = dischord / 4
+        if not hasattr(self, "outcomes"):
+            self.outcomes = {}
         if self.index == 0:
             fusion.character = 0
+            self.outcomes[index] = "normal"
         elif random.randint(1, 100) <= harmony:
             fusion.character = random.choice(SUPER_FUSIONS)
+            self.outcomes[index] = "super"
         elif random.randint(1, 100) <= dischord:
             fusion.character = random.choice(CHAOS_FUSIONS)
+            self.outcomes[index] = "chaos"
         else:
             fusion.character = self.index * 2
+            self.outcomes[index] = "normal"
 
 
-class FusionObject(TableObject):
+class FusionObject(RomTableObject):
     @property
     def charname(self):
         assert not (self.character % 2)
@@ -306,12 +900,13 @@ class FusionObject(TableObject):
         return s
 
 
-class UnknownObject(TableObject):
+class UnknownObject(RomTableObject):
+    columnar = True
+
     @property
     def parent(self):
-        cands = [u for u in Unknown2Object.every
-                 if u.unk_pointer <= (self.pointer & 0xFFFF)]
-        parent = max(cands, key=lambda u: u.unk_pointer)
+        parent = Unknown2Object.find_by_pointer_floor(
+            self.pointer & 0xFFFF, attr="unk_pointer")
         assert parent.unk_pointer <= (self.pointer & 0xFFFF)
         return parent
 
@@ -320,11 +915,11 @@ class UnknownObject(TableObject):
         return self.parent.groupindex
 
 
-class Unknown2Object(TableObject):
+class Unknown2Object(RomTableObject):
     pass
 
 
-class FormDataObject(TableObject):
+class FormDataObject(RomTableObject):
     '''
     FORMAT:
         Every enemy in the formation is separated by a FF byte.
@@ -339,30 +934,38 @@ class FormDataObject(TableObject):
         return FormationObject.get(self.index)
 
 
-class GraphicsObject(TableObject):
+class GraphicsObject(RomTableObject):
+    columnar = True
+
     @property
     def palette(self):
         if self.palette_address == 0:
             return None
 
-        palette = [p for p in PaletteObject
-                   if self.palette_address == p.pointer & 0xFFFF]
+        palette = PaletteObject.find_by_pointer(self.palette_address,
+                                                mask=0xFFFF)
         if len(palette) != 1:
             return None
 
         return palette[0]
 
 
-class PaletteObject(TableObject):
+class PaletteObject(RomTableObject):
     def mutate(self):
-        if hasattr(self, "done") and self.done:
-            return
         t = get_snes_palette_transformer()
         self.colors = t(self.colors)
-        self.done = True
 
+    @classmethod
+    def mutate_all(cls, palettes):
+        done = set([])
+        for p in palettes:
+            if p is None or p in done:
+                continue
+            done.add(p)
+            p.mutate()
 
-class RecipeObject(TableObject):
+
+class RecipeObject(RomTableObject):
     @property
     def item(self):
         return ItemObject.get(self.index+1)
@@ -384,12 +987,31 @@ class RecipeObject(TableObject):
             r.score = s
 
 
-class ZoneObject(TableObject):
+class ZoneObject(RomTableObject):
+    @classproperty
+    def formation_zones(cls):
+        if session.formation_zones is None:
+            formation_zones = {}
+            for z in ZoneObject.every:
+                for f in z.formation_indexes:
+                    formation_zones.setdefault(f, set()).add(z.index)
+            session.formation_zones = formation_zones
+        return session.formation_zones
+
     @property
     def formations(self):
         return [FormationObject.get(f) for f in self.formation_indexes]
 
+    def reindex_formations(self, old_indexes):
+        if session.formation_zones is None:
+            return
+        for f in set(old_indexes):
+            session.formation_zones[f].discard(self.index)
+        for f in set(self.formation_indexes):
+            session.formation_zones.setdefault(f, set()).add(self.index)
+
     def mutate(self):
+        old_indexes = self.formation_indexes
         indexes = sorted(set(self.formation_indexes))
         new_indexes = list(indexes)
         while len(new_indexes) < 8:
@@ -397,6 +1019,7 @@ class ZoneObject(TableObject):
         random.shuffle(new_indexes)
         self.formation_indexes = new_indexes
         assert len(self.formation_indexes) == 8
+        self.reindex_formations(old_indexes)
 
     def __repr__(self):
         s = "\n".join([str(f) for f in self.formations])
@@ -404,7 +1027,8 @@ class ZoneObject(TableObject):
         return s
 
 
-class FormationObject(TableObject):
+class FormationObject(RomTableObject):
+    columnar = True
     original_enemies = {}
     mould_candidates = {}
     moulds = []
@@ -415,6 +1039,18 @@ class FormationObject(TableObject):
                         for e in self.enemies])
         return s
 
+    @classproperty
+    def monster_formations(cls):
+        if session.monster_formations is None:
+            monster_formations = {}
+            for f in FormationObject.every:
+                for eid in f.enemy_ids:
+                    if eid != 0xFF:
+                        monster_formations.setdefault(eid, set()).add(
+                            f.index)
+            session.monster_formations = monster_formations
+        return session.monster_formations
+
     @property
     def formdata(self):
         return FormDataObject.get(self.index)
@@ -437,7 +1073,16 @@ class FormationObject(TableObject):
         rank = sum(ranks) / len(ranks)
         return rank
 
+    def reindex_enemies(self, old_ids):
+        if session.monster_formations is None:
+            return
+        for eid in set(old_ids) - set([0xFF]):
+            session.monster_formations[eid].discard(self.index)
+        for eid in set(self.enemy_ids) - set([0xFF]):
+            session.monster_formations.setdefault(eid, set()).add(self.index)
+
     def mutate(self):
+        old_ids = list(self.enemy_ids)
         num_different = len(set(self.enemies))
         similars = [f for f in FormationObject if f.mould == self.mould
                     and len(f.enemies) >= num_different]
@@ -457,10 +1102,10 @@ class FormationObject(TableObject):
                     break
             else:
                 self.enemy_ids[index] = random.choice(ids)
-        return
+        self.reindex_enemies(old_ids)
 
 
-class InitialObject(TableObject):
+class InitialObject(RomTableObject):
     def __repr__(self):
         return "%x %x" % (self.addr, self.value)
 
@@ -501,13 +1146,12 @@ class InitialObject(TableObject):
         self.addr |= index
 
 
-class SpellObject(TableObject):
-    rankings = {}
-
+class SpellObject(RomTableObject):
     @property
     def rank(self):
-        if self.rankings:
-            return self.rankings[self]
+        rankings = session.spell_rankings
+        if rankings:
+            return rankings[self]
         f = open(spell_level_file)
         for line in f:
             line = line.strip()
@@ -519,14 +1163,14 @@ class SpellObject(TableObject):
             index, level = int(index, 0x10), int(level)
             rank = level
             so = SpellObject.get(index)
-            self.rankings[so] = rank
+            rankings[so] = rank
         f.close()
         for so in SpellObject.every:
-            assert so in self.rankings
+            assert so in rankings
         return self.rank
 
 
-class CharacterObject(TableObject):
+class CharacterObject(RomTableObject):
     stattrs = ["strength", "stamina", "agility", "wisdom", "luck",
                "max_hp", "max_ap"]
 
@@ -602,8 +1246,10 @@ class CharacterObject(TableObject):
             setattr(self, attr, value)
 
 
-class ItemObject(TableObject):
-    equip_dict = {}
+class ItemObject(RomTableObject):
+    columnar = True
+    rank_attrs = ["name", "price", "misc1", "equippable", "power",
+                  "itemtype"]
     suffix_dict = {
         None: ["BR", "BT", "SF"],
         0x05: ["DR"], 0x8a: ["SD"], 0x8b: ["DR"], 0x8c: ["RP"], 0x8d: [],
@@ -616,7 +1262,6 @@ class ItemObject(TableObject):
         "armor": [0x94, 0x95], "helmet": [0x93], "shield": [0x96],
         "accessory": [None],
         }
-    newnames = []
     suffixes = sorted(set([sx for sxlist in suffix_dict.values()
                            for sx in sxlist]))
     for sx in suffixes:
@@ -708,21 +1353,37 @@ class ItemObject(TableObject):
             return True
         return self.get_bit("cant_be_sold") and not self.equippable
 
+    def get_kind(self, kinds):
+        return tuple([getattr(self, "is_%s" % t) for t in kinds])
+
+    @classmethod
+    def get_kind_candidates(cls, kinds):
+        index = cls.get_ranked_index()
+        ranked = index.get_ranked()
+        if kinds not in index.derived:
+            by_kind = {}
+            for i in ranked:
+                if index.get_rank(i) >= 0 and not i.key_item:
+                    by_kind.setdefault(i.get_kind(kinds), []).append(i)
+            for kind, candidates in by_kind.items():
+                positions = dict((c, n) for (n, c) in enumerate(candidates))
+                by_kind[kind] = candidates, positions
+            index.derived[kinds] = by_kind
+        return index.derived[kinds]
+
     def get_similar(self, same_kind=False, similar_kind=False):
         if self.key_item or self.rank < 0:
             return self
-        candidates = [i for i in ItemObject.ranked if
-                      i.rank >= 0 and not i.key_item]
         if same_kind:
-            candidates = [i for i in candidates if all([
-                getattr(i, "is_%s" % t) == getattr(self, "is_%s" % t)
-                for t in ["weapon", "armor", "helmet",
-                          "shield", "fishing", "accessory"]])]
+            kinds = ("weapon", "armor", "helmet",
+                     "shield", "fishing", "accessory")
         elif similar_kind:
-            candidates = [i for i in candidates if all([
-                getattr(i, "is_%s" % t) == getattr(self, "is_%s" % t)
-                for t in ["equippable", "fishing", "accessory"]])]
-        index = candidates.index(self)
+            kinds = ("equippable", "fishing", "accessory")
+        else:
+            kinds = ()
+        candidates, positions = (
+            ItemObject.get_kind_candidates(kinds)[self.get_kind(kinds)])
+        index = positions[self]
         index = mutate_normal(index, maximum=len(candidates)-1)
         return candidates[index]
 
@@ -741,18 +1402,19 @@ class ItemObject(TableObject):
         if self.index <= 0x3e:
             return
 
-        if not self.equip_dict:
+        equip_dict = session.equip_dict
+        if not equip_dict:
             for sx in self.suffixes:
-                self.equip_dict[sx] = []
+                equip_dict[sx] = []
             for i in ItemObject.every:
                 if i.index <= 0x5b or i.is_accessory or not i.display_name:
                     continue
                 if i.is_dragon or i.itemtype in self.suffix_dict[i.suffix]:
-                    self.equip_dict[i.suffix].append(i.equippable)
+                    equip_dict[i.suffix].append(i.equippable)
                 else:
                     suffix = random.choice(self.suffix_dict[i.itemtype])
                     if i.equippable != 0xFF:
-                        self.equip_dict[suffix].append(i.equippable)
+                        equip_dict[suffix].append(i.equippable)
 
         if self.is_accessory:
             while random.randint(1, 25) == 25:
@@ -772,19 +1434,20 @@ class ItemObject(TableObject):
                 suffix = random.choice(suffixes)
 
                 display_name = self.display_name[:-len(self.suffix)] + suffix
-                if display_name in self.newnames:
-                    if self.display_name not in self.newnames:
+                newnames = session.newnames
+                if display_name in newnames:
+                    if self.display_name not in newnames:
                         break
-                self.newnames.append(display_name)
+                newnames.append(display_name)
 
                 self.itemtype = itemtype
-                self.equippable = random.choice(self.equip_dict[suffix])
+                self.equippable = random.choice(equip_dict[suffix])
                 self.name = display_name + "".join(
                     [chr(0) for _ in xrange(8-len(display_name))])
                 assert len(self.name) == 8
 
 
-class DropObject(TableObject):
+class DropObject(RomTableObject):
     def __repr__(self):
         s = "%x " % self.index
         return s + ", ".join([i.display_name for i in self.items])
@@ -810,94 +1473,77 @@ class DropObject(TableObject):
         self.common, self.rare = tuple(items)
 
 
-class LevelUp:
-    pairs = [("hp", "ap"),
-             ("strength", "stamina"),
-             ("dummy", "agility"),
-             ("wisdom", "luck")]
-
-    def __init__(self, level, block):
-        self.level = level
-        for pair, value in zip(self.pairs, block):
-            value = ord(value)
-            a, b = pair
-            setattr(self, a, value >> 4)
-            setattr(self, b, value & 0xf)
-
-    def __repr__(self):
-        s = "%s -" % self.level
-        for pair in self.pairs:
-            for attr in pair:
-                if attr == "dummy":
-                    continue
-                s += " %s: %s," % (attr, getattr(self, attr))
-        return s
-
-    @property
-    def max_hp(self):
-        return self.hp
-
-    @property
-    def max_ap(self):
-        return self.ap
-
-    @property
-    def block(self):
-        block = ""
-        for a, b in self.pairs:
-            assert getattr(self, a) <= 0xf
-            assert getattr(self, b) <= 0xf
-            value = (getattr(self, a) << 4) | (getattr(self, b))
-            block += chr(value)
-        return block
-
-
-class LevelUpObject(TableObject):
-    done_shuffled = False
+class LevelUpObject(RomTableObject):
+    '''
+    Each level from 2 to 99 is a 4 byte block, one byte per pair of stats
+    with the first stat of the pair in the high nibble. The stats are kept
+    unpacked as one bytearray per stat, indexed by level - 2.
+    '''
     maxdict = {"hp": 999, "ap": 511,
                "strength": 255, "agility": 511, "stamina": 255,
                "wisdom": 255, "luck": 255
                }
+    pairs = [("hp", "ap"),
+             ("strength", "stamina"),
+             ("dummy", "agility"),
+             ("wisdom", "luck")]
+    aliases = {"max_hp": "hp", "max_ap": "ap"}
+    high_nibbles = "".join([chr(i >> 4) for i in xrange(0x100)])
+    low_nibbles = "".join([chr(i & 0xf) for i in xrange(0x100)])
+    shifted_nibbles = "".join([chr((i << 4) & 0xff) for i in xrange(0x100)])
 
     def read_data(self, filename=None, pointer=None):
         super(LevelUpObject, self).read_data(filename, pointer=pointer)
-        self.levels = {}
-        for i in xrange(98):
-            level_index = i + 2
-            block = self.data[i*4:(i+1)*4]
-            assert len(block) == 4
-            lv = LevelUp(level_index, block)
-            self.levels[level_index] = lv
+        assert len(self.data) == 392
+        self.stats = {}
+        for i, (a, b) in enumerate(self.pairs):
+            column = self.data[i::4]
+            self.stats[a] = bytearray(column.translate(self.high_nibbles))
+            self.stats[b] = bytearray(column.translate(self.low_nibbles))
+        self.growth = {}
+
+    def get_dirty_fields(self):
+        original = session.originals.get((type(self), self.index))
+        if original is None or self.stats != original["stats"]:
+            return ["data"]
+        return []
 
     def write_data(self, filename=None, pointer=None):
         if self.index >= 8:
             return
-        self.data = ""
-        for i in xrange(98):
-            level_index = i + 2
-            self.data += self.levels[level_index].block
-        assert len(self.data) == 392
+        data = bytearray(392)
+        for i, (a, b) in enumerate(self.pairs):
+            high, low = self.stats[a], self.stats[b]
+            assert max(high) <= 0xf
+            assert max(low) <= 0xf
+            data[i::4] = bytearray(map(or_, high.translate(
+                self.shifted_nibbles), low))
+        self.data = str(data)
         super(LevelUpObject, self).write_data(filename, pointer=pointer)
 
     def value_at_level(self, attr, level):
-        values = [getattr(self.levels[i], attr) for i in xrange(2, level+1)]
-        return sum(values)
+        attr = self.aliases.get(attr, attr)
+        if attr not in self.growth:
+            growth = [0, 0]
+            for value in self.stats[attr]:
+                growth.append(growth[-1] + value)
+            self.growth[attr] = growth
+        return self.growth[attr][max(level, 1)]
 
     def zero_attr(self, attr):
-        for level in self.levels.values():
-            setattr(level, attr, 0)
+        self.stats[attr] = bytearray(98)
+        self.growth = {}
 
     def mutate(self):
-        if not LevelUpObject.done_shuffled:
-            LevelUpObject.done_shuffled = True
+        if not session.levelups_shuffled:
+            session.levelups_shuffled = True
             levelups = [l for l in LevelUpObject.every if l.index <= 7]
             for attr in sorted(self.maxdict):
-                ups = [[getattr(l.levels[i], attr) for i in xrange(2, 100)]
-                       for l in levelups]
+                ups = [l.stats[attr] for l in levelups]
                 random.shuffle(ups)
                 for l, us in zip(levelups, ups):
-                    for i, u in enumerate(us):
-                        setattr(l.levels[i+2], attr, u)
+                    l.stats[attr] = us
+                    l.growth = {}
 
         return
         if self.index >= 8:
@@ -919,20 +1565,22 @@ class LevelUpObject(TableObject):
                 targets[target] = value
             self.zero_attr(attr)
             indices = [1] + sorted(targets)
+            stats = self.stats[attr]
             for a, b in zip(indices, indices[1:]):
-                candidates = [self.levels[i+1] for i in range(a, b)]
+                candidates = [i+1 for i in range(a, b)]
                 points = targets[b] - targets[a]
                 while points > 0:
                     if not candidates:
                         break
                     c = random.choice(candidates)
-                    setattr(c, attr, getattr(c, attr) + 1)
+                    stats[c-2] += 1
                     points -= 1
-                    if getattr(c, attr) == 0xf:
+                    if stats[c-2] == 0xf:
                         candidates.remove(c)
+            self.growth = {}
 
 
-class TreasureObject(TableObject):
+class TreasureObject(RomTableObject):
     @property
     def display_name(self):
         try:
@@ -956,8 +1604,6 @@ class ChestObject(TreasureObject):
 
 
 class DresserObject(TreasureObject):
-    addrdict = {}
-
     def __repr__(self):
         contents = self.contents
         try:
@@ -968,20 +1614,22 @@ class DresserObject(TreasureObject):
                                 itemname)
 
     def mutate(self):
-        if self.address in self.addrdict:
-            self.contents = self.addrdict[self.address]
+        addrdict = session.dresser_contents
+        if self.address in addrdict:
+            self.contents = addrdict[self.address]
             return
 
         self.contents = self.item.get_similar(similar_kind=True).index
         assert self.contents > 0
-        self.addrdict[self.address] = self.contents
+        addrdict[self.address] = self.contents
 
 
-class MonsterObject(TableObject):
-    minmax_dict = {}
+class MonsterObject(RomTableObject):
+    columnar = True
     maxdict = {"hp": 65535, "ap": 65535, "luck": 255,
                "atp": 511, "dfp": 511,
                "agl": 511, "ms": 7, "xp": 65535, "gp": 65535}
+    rank_attrs = ["name", "hp", "luck", "atp", "dfp"]
 
     def __repr__(self):
         s = "{0:02x} {1}".format(
@@ -996,25 +1644,21 @@ class MonsterObject(TableObject):
     def palette(self):
         return self.graphics.palette
 
-    def mutate_palette(self):
-        if self.is_boss:
-            return
-        if self.palette is not None:
-            self.palette.mutate()
+    @classmethod
+    def mutate_palettes(cls):
+        PaletteObject.mutate_all([m.palette for m in MonsterObject.every
+                                  if not m.is_boss])
 
     @property
     def is_boss(self):
-        for f in FormationObject:
-            if self in f.enemies:
-                return False
-        return True
+        return not FormationObject.monster_formations.get(self.index)
 
     @property
     def is_overworld(self):
-        for z in ZoneObject:
-            for f in z.formations:
-                if self in f.enemies:
-                    return True
+        formation_zones = ZoneObject.formation_zones
+        for f in FormationObject.monster_formations.get(self.index, []):
+            if formation_zones.get(f):
+                return True
         return False
 
     @property
@@ -1027,19 +1671,20 @@ class MonsterObject(TableObject):
             return -1
 
         attrs = ["hp", "luck", "atp", "dfp"]
-        if not self.minmax_dict:
+        minmax_dict = session.minmax_dict
+        if not minmax_dict:
             for attr in attrs:
-                values = [getattr(m, attr) for m in MonsterObject.every]
+                values = MonsterObject.get_column(attr)
                 minval = min([v for v in values if v > 0])
                 minval = min([v for v in values if v > minval])
                 maxval = max([v for v in values])
                 maxval = max([v for v in values if v < maxval])
-                self.minmax_dict[attr] = minval, maxval
+                minmax_dict[attr] = minval, maxval
             return self.rank
         attr_ranks = []
         for attr in attrs:
             value = getattr(self, attr)
-            minval, maxval = self.minmax_dict[attr]
+            minval, maxval = minmax_dict[attr]
             value = min(maxval, max(minval, value))
             attr_rank = float(value - minval) / (maxval - minval)
             attr_ranks.append(attr_rank)
@@ -1055,15 +1700,15 @@ class MonsterObject(TableObject):
         self.treasure_class = mutate_normal(self.treasure_class, maximum=6)
 
     def mutate_stats(self):
-        self.xp *= (4.0 / (2**difficulty))
-        self.gp *= (4.0 / (2**difficulty))
+        difficulty = session.difficulty
+        scales = {"xp": 4.0 / (2**difficulty), "gp": 4.0 / (2**difficulty)}
         ranked = MonsterObject.ranked
-        modifactor = (ranked.index(self) / float(len(ranked)-1))
+        modifactor = (self.get_rank_position() / float(len(ranked)-1))
         modifactor = (modifactor ** 2) / 2.0
         modifactor = modifactor * (difficulty**0.5)
         for attr in sorted(self.maxdict):
             maxval = self.maxdict[attr]
-            value = getattr(self, attr)
+            value = getattr(self, attr) * scales.get(attr, 1)
             minimum = min(1, value)
             if modifactor > 0:
                 value = int(round(value * (1 + modifactor)))
@@ -1099,42 +1744,47 @@ class MonsterObject(TableObject):
 
     @classmethod
     def randomize_names(cls):
-        done_names = []
+        done_names = set([])
+        done_substrings = set([])
         monsters = [m for m in MonsterObject.ranked if not m.is_boss]
-        generate_name(namegen_table=name_generator_file)
+        load_name_generator()
         for m in monsters:
             while True:
                 name = generate_name(maxsize=8)
-                for done_name in done_names:
-                    if name in done_name or done_name in name:
-                        break
-                else:
-                    done_names.append(name)
-                    while len(name) < 8:
-                        name += " "
-                    assert len(name) == 8
-                    name = name.replace(" ", chr(0))
-                    m.name = name
-                    break
+                substrings = get_substrings(name)
+                if name in done_substrings or substrings & done_names:
+                    continue
+                done_names.add(name)
+                done_substrings |= substrings
+                while len(name) < 8:
+                    name += " "
+                assert len(name) == 8
+                name = name.replace(" ", chr(0))
+                m.name = name
+                break
 
 
-class LearnObject(TableObject):
-    done_shuffled = False
+class LearnObject(RomTableObject):
+    lazy = False
+    cached_fields = ["levels", "spell_indexes"]
 
-    def __init__(self, filename, index, pointer, endpointer):
-        self.filename = filename
+    def __init__(self, index, pointer, data):
         self.pointer = pointer
         self.index = index
-        if filename:
-            self.read_data(filename, pointer, endpointer)
+        self.read_data(data)
 
     @classproperty
     def every(self):
         return get_learn_spells()
 
     @classmethod
-    def get(self, index):
-        return [l for l in get_learn_spells() if l.index == index][0]
+    def get(cls, index):
+        if session.learn_index is None:
+            get_learn_spells()
+        return session.learn_index[index]
+
+    def get_rom_range(self):
+        return None
 
     @property
     def spells(self):
@@ -1159,21 +1809,16 @@ class LearnObject(TableObject):
         if self.spell_indexes and not isinstance(self.spell_indexes[0], int):
             self.spell_indexes = [s.index for s in self.spell_indexes]
 
-    def read_data(self, filename, pointer, endpointer):
-        f = open(filename, 'r+b')
-        f.seek(pointer)
+    def read_data(self, data):
         self.levels, self.spell_indexes = [], []
-        while pointer < endpointer:
-            level, spell = tuple(map(ord, f.read(2)))
+        for level, spell in zip(data[0::2], data[1::2]):
             if level == 0:
                 break
             self.levels.append(level)
             self.spell_indexes.append(spell)
-            pointer += 2
-        f.close()
 
-    def write_data(self, filename, pointer):
-        f = open(filename, 'r+b')
+    def write_data(self, pointer):
+        f = session.rom
         for level, spell in self.pairs:
             if f.tell() >= 0x5aaf8:
                 print "Notice: Spell overflow. Planned spells were cut."
@@ -1184,12 +1829,11 @@ class LearnObject(TableObject):
         f.seek(pointer)
         assert f.tell() < 0x5ab00
         f.write(chr(0))
-        f.close()
         pointer += 1
         return pointer
 
     def mutate(self):
-        if not LearnObject.done_shuffled:
+        if not session.learns_shuffled:
             candidates = [l for l in LearnObject.every if l.index != 0]
             candidates = [(l, list(l.spell_indexes), list(l.levels))
                           for l in candidates]
@@ -1200,7 +1844,7 @@ class LearnObject(TableObject):
                 _, spell_indexes, levels = b
                 l.spell_indexes = list(spell_indexes)
                 l.levels = list(levels)
-            LearnObject.done_shuffled = True
+            session.learns_shuffled = True
 
         spell_indexes = []
         for s in self.spells:
@@ -1233,39 +1877,39 @@ class LearnObject(TableObject):
             *sorted(zip(self.levels, self.spell_indexes)))
 
 
-class ShopObject(TableObject):
-    def __init__(self, filename, index, pointer):
-        self.filename = filename
+class ShopObject(RomTableObject):
+    lazy = False
+    cached_fields = ["contents"]
+
+    def __init__(self, index, pointer, data):
         self.pointer = pointer
         self.index = index
-        if filename:
-            self.read_data(filename, pointer)
+        self.read_data(data)
 
     @classproperty
     def every(self):
         return get_shops()
 
+    @classmethod
+    def get(cls, index):
+        if session.shop_index is None:
+            get_shops()
+        return session.shop_index[index]
+
     @property
     def items(self):
         return [ItemObject.get(i) for i in self.contents]
 
-    def read_data(self, filename, pointer):
-        f = open(filename, 'r+b')
-        self.contents = []
-        while True:
-            f.seek(pointer)
-            value = ord(f.read(1))
-            if value == 0:
-                break
-            self.contents.append(value)
-            pointer += 1
-        f.close()
+    def read_data(self, data):
+        self.contents = map(ord, data)
+
+    def get_rom_range(self):
+        return self.pointer, self.pointer + len(self.contents)
 
     def write_data(self):
-        f = open(self.filename, 'r+b')
+        f = session.rom
         f.seek(self.pointer)
         f.write("".join([chr(c) for c in self.contents]))
-        f.close()
 
     def mutate(self):
         new_contents = []
@@ -1282,35 +1926,39 @@ class ShopObject(TableObject):
         self.contents = new_contents
 
 
-def get_learn_spells(filename=None):
-    global g_learns
-    if g_learns is not None:
-        return list(g_learns)
+def get_learn_spells():
+    if session.learns is not None:
+        return list(session.learns)
 
-    pointer = 0x5aa00
-    f = open(filename, 'r+b')
+    pointer = LEARN_POINTER
+    f = session.rom
+    f.seek(pointer)
+    offsets = Struct("<10H").unpack(f.read(20))
+    start, end = pointer + min(offsets), pointer + max(offsets)
+    f.seek(start)
+    block = bytearray(f.read(end + 1 - start))
     learns = []
     for i in xrange(9):
-        f.seek(pointer + (2*i))
-        subpointer = pointer + read_multi(f, 2)
-        f.seek(pointer + (2*i) + 2)
-        endpointer = pointer + read_multi(f, 2)
-        l = LearnObject(filename, i, subpointer, endpointer)
-        learns.append(l)
-    f.close()
-    g_learns = learns
+        subpointer = pointer + offsets[i]
+        endpointer = pointer + offsets[i+1]
+        if endpointer > subpointer:
+            # a record is read in whole pairs, even past its end
+            endpointer += (endpointer - subpointer) % 2
+        data = block[subpointer-start:endpointer-start]
+        learns.append(LearnObject(i, subpointer, data))
+    session.learns = learns
+    session.learn_index = dict((l.index, l) for l in learns)
     return get_learn_spells()
 
 
-def write_learn_spells(filename):
-    f = open(filename, 'r+b')
-    pointer = 0x5aa00
+def write_learn_spells():
+    f = session.rom
+    pointer = LEARN_POINTER
     subpointer = pointer + (len(LearnObject.every)*2)
     for l in LearnObject.every:
         f.seek(pointer + (2*l.index))
-        write_multi(f, subpointer-0x5aa00, 2)
-        subpointer = l.write_data(filename, subpointer)
-    f.close()
+        write_multi(f, subpointer-pointer, 2)
+        subpointer = l.write_data(subpointer)
 
 
 def fix_initial_spells():
@@ -1378,27 +2026,25 @@ def set_warps_free():
         SpellObject.get(index).cost = 0
 
 
-def get_shops(filename=None):
-    global g_shops
-    if g_shops is not None:
-        return list(g_shops)
+def get_shops():
+    if session.shops is not None:
+        return list(session.shops)
 
-    pointer = 0x3fac0
+    pointer = SHOP_POINTER
     maxpointer = 0x3fbad
+    f = session.rom
+    end = f.data.find(chr(0), maxpointer)
+    f.seek(pointer)
+    block = f.read(end - pointer)
     shops = []
-    f = open(filename, 'r+b')
-    for i in xrange(1000):
-        f.seek(pointer)
-        s = ShopObject(filename, i, pointer)
-        shops.append(s)
-        pointer = s.pointer + len(s.contents) + 1
-        if pointer > maxpointer:
-            break
-    else:
-        raise Exception("Too many shops.")
-    f.close()
-
-    g_shops = shops
+    for i, data in enumerate(block.split(chr(0))):
+        if i >= 1000:
+            raise Exception("Too many shops.")
+        shops.append(ShopObject(i, pointer, data))
+        pointer += len(data) + 1
+
+    session.shops = shops
+    session.shop_index = dict((s.index, s) for s in shops)
     return get_shops()
 
 
@@ -1414,13 +2060,16 @@ def randomize_fusions():
         for index, boosts in all_boosts:
             all_all_boosts.append((c.index, index, sum(boosts)))
 
-    all_all_boosts = sorted(all_all_boosts, key=lambda (a, b, c): c)
-    for c_index, index, _ in all_all_boosts[:-len(FusionObject.every)]:
-        c = ComboObject.get(c_index)
-        c.nullify(index)
-        all_all_boosts.remove((c_index, index, _))
+    # keep the strongest boosts, with later pairs winning ties
+    keep = set(heapq.nlargest(len(FusionObject.every),
+                              xrange(len(all_all_boosts)),
+                              key=lambda i: (all_all_boosts[i][2], i)))
+    for i, (c_index, index, _) in enumerate(all_all_boosts):
+        if i not in keep:
+            ComboObject.get(c_index).nullify(index)
 
-    all_all_boosts = sorted(all_all_boosts)
+    all_all_boosts = sorted([b for (i, b) in enumerate(all_all_boosts)
+                             if i in keep])
     assert len(all_all_boosts) == len(FusionObject.every)
     for i, (c_index, index, _) in enumerate(all_all_boosts):
         c = ComboObject.get(c_index)
@@ -1428,17 +2077,9 @@ def randomize_fusions():
         c.set_fusion(index, f)
 
 
-def randomize_othello(filename):
-    prizes = [(0x9220, ['SD', 'RP']),
-              (0x9255, 'WP'),
-              (0x9278, 'BW'),
-              (0x929b, 'HT'),
-              (0x95e1, 'DR'),
-              (0x9616, 'ST'),
-              (0x9639, ['AR', 'ML']),
-              (0x965C, 'SH')]
-    f = open(filename, "r+b")
-    for address, types in prizes:
+def randomize_othello():
+    f = session.rom
+    for address, types in OTHELLO_PRIZES:
         if not isinstance(types, list):
             types = [types]
         f.seek(address)
@@ -1456,19 +2097,649 @@ def randomize_othello(filename):
                 chosen = random.choice(candidates[index:])
         f.seek(address)
         f.write(chr(chosen.index))
-    f.close()
 
 
-def lower_encounter_rate(filename):
-    f = open(filename, 'r+b')
+def lower_encounter_rate():
+    f = session.rom
     f.seek(0x32750)
     f.write("".join(map(chr, [0x22, 0x00, 0x49, 0xc5])))
     f.seek(0x54900)
     reduction = [0x4a] * 3
     f.write("".join(map(chr, [0x85, 0x1c] + reduction + [0x6b])))
+
+
+def get_all_objects():
+    return [g for g in globals().values()
+            if isinstance(g, type) and issubclass(g, TableObject)
+            and g not in [TableObject, RomTableObject, TreasureObject]]
+
+
+def get_all_object_names():
+    return [ao.__name__ for ao in get_all_objects()]
+
+
+def install_table_fields():
+    for ao in get_all_objects():
+        if ao.lazy:
+            ao.install_fields()
+
+
+install_table_fields()
+
+
+def get_overlapping_records(objs):
+    '''
+    Groups of records whose rom ranges overlap, such as the pointed tables
+    that share their pointer block.
+    '''
+    ranges = sorted([(o.get_rom_range(), n) for (n, o) in enumerate(objs)
+                     if o.get_rom_range() is not None])
+    groups, group, end = [], [], None
+    for (start, stop), n in ranges:
+        if group and start < end:
+            group.append(objs[n])
+            end = max(end, stop)
+            continue
+        if len(group) > 1:
+            groups.append(group)
+        group, end = [objs[n]], stop
+    if len(group) > 1:
+        groups.append(group)
+    return groups
+
+
+def get_changed_summary():
+    '''
+    The modified fields of every modified record, and the rom ranges that
+    differ from the source rom. Only touched records are compared, so this
+    decodes nothing that the randomizer didn't assign.
+    '''
+    records = {}
+    for ao in get_all_objects():
+        for o in ao.every:
+            if not o.is_touched():
+                continue
+            fields = o.get_dirty_fields()
+            if fields:
+                records.setdefault(ao.__name__, []).append(
+                    {"index": o.index, "fields": fields})
+    ranges = ["%x-%x" % (start, end)
+              for (start, end) in session.rom.get_changed_ranges(maxgap=0)]
+    return {"records": records, "ranges": ranges}
+
+
+def get_outfiles(sourcefile, seed, patch=False):
+    outfile = sourcefile.split(".")
+    extension = "ips" if patch else outfile[-1]
+    outfile = outfile[:-1] + [str(seed), extension]
+    txtfile = ".".join(outfile[:-1] + ["txt"])
+    outfile = ".".join(outfile)
+    return outfile, txtfile
+
+
+def get_peak_memory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform == "darwin":
+        peak /= 1024
+    return peak
+
+
+def get_change(before, after):
+    if before is None or after is None:
+        return None
+    return after - before
+
+
+def get_resident_memory():
+    if resource is None or not path.exists("/proc/self/statm"):
+        return None
+    f = open("/proc/self/statm")
+    resident = int(f.read().split()[1])
+    f.close()
+    return resident * resource.getpagesize() / 1024
+
+
+class PhaseProfiler(object):
+    '''
+    Records wall time, memory use and call counts of a few hot methods for
+    each phase of a randomization, and optionally keeps a cProfile dump of
+    every phase. Memory is in kilobytes: "memory_change" is the change in
+    resident memory over the phase (Linux only), and "peak_memory_growth"
+    is how far the phase raised the process's peak memory. Neither is the
+    phase's own peak. The counting wrappers are only in place between
+    install() and uninstall(), and mutate_normal is counted in every module
+    that imported it, including randomtools itself.
+    '''
+    hot_methods = ["get_similar", "rank"]
+
+    def __init__(self, use_cprofile=False):
+        self.use_cprofile = use_cprofile
+        self.phases = []
+        self.profiles = []
+        self.patched = []
+        self.counts = dict((name, 0) for name in
+                           self.hot_methods + ["mutate_normal"])
+
+    def counter(self, name, function):
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def install(self):
+        for cls in [TableObject, RomTableObject] + get_all_objects():
+            for name in self.hot_methods:
+                if name not in cls.__dict__:
+                    continue
+                original = cls.__dict__[name]
+                if isinstance(original, property):
+                    counted = property(self.counter(name, original.fget))
+                else:
+                    counted = self.counter(name, original)
+                self.patched.append((cls, name, original))
+                setattr(cls, name, counted)
+        original = mutate_normal
+        counted = self.counter("mutate_normal", original)
+        for module in modules.values():
+            if getattr(module, "mutate_normal", None) is original:
+                self.patched.append((module, "mutate_normal", original))
+                setattr(module, "mutate_normal", counted)
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    @contextmanager
+    def phase(self, name):
+        counts = dict(self.counts)
+        memory, peak = get_resident_memory(), get_peak_memory()
+        profile = cProfile.Profile() if self.use_cprofile else None
+        start = time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.profiles.append((name, profile))
+            self.phases.append({
+                "name": name,
+                "time": time() - start,
+                "calls": dict((k, self.counts[k] - counts[k])
+                              for k in self.counts),
+                "memory_change": get_change(memory, get_resident_memory()),
+                "peak_memory_growth": get_change(peak, get_peak_memory()),
+                })
+
+    def write_report(self, basename, **info):
+        report = dict(info)
+        report["phases"] = self.phases
+        report["time"] = sum([p["time"] for p in self.phases])
+        report["peak_memory"] = get_peak_memory()
+        f = open("%s.profile.json" % basename, "w+")
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()
+        for name, profile in self.profiles:
+            profile.dump_stats("%s.%s.prof" % (basename, name))
+
+
+class RandomizerSession(object):
+    '''
+    Owns the parsed source rom and every piece of mutable randomizer state,
+    so that one process can produce any number of seeds. The table objects
+    themselves are registered process-wide by randomtools, so loading a
+    session reads them from its rom, snapshots their parsed state, and
+    reset() restores that snapshot. Loading a different rom rebuilds them,
+    and a session whose rom is no longer the loaded one reloads on reset().
+    '''
+
+    def __init__(self, sourcefile=None, difficulty=1.0):
+        self.sourcefile = None
+        self.rom = None
+        self.snapshot = None
+        self.originals = {}
+        self.overlaps = []
+        self.columns = {}
+        self.column_snapshot = {}
+        self.learns = None
+        self.learn_index = None
+        self.shops = None
+        self.shop_index = None
+        self.spell_rankings = {}
+        self.difficulty = difficulty
+        self.profiler = None
+        self.pool = None
+        self.clear()
+        if sourcefile is not None:
+            self.load(sourcefile)
+
+    def clear(self):
+        self.shamans = dict((e, ShamanCompat(e)) for e in ELEMENTS)
+        self.done_affinities = []
+        self.equip_dict = {}
+        self.newnames = []
+        self.dresser_contents = {}
+        self.minmax_dict = {}
+        self.levelups_shuffled = False
+        self.learns_shuffled = False
+        self.clear_caches()
+
+    def clear_caches(self):
+        self.ranked_cache = {}
+        self.pointer_indexes = {}
+        self.monster_formations = None
+        self.formation_zones = None
+
+    def activate(self):
+        global session
+        session = self
+        return self
+
+    def load(self, sourcefile):
+        global g_table_skeletons, g_table_source
+        self.activate()
+        self.sourcefile = sourcefile
+        self.rom = RomBuffer(sourcefile)
+        self.clear()
+        self.spell_rankings = {}
+        if g_table_source is not None and g_table_source != self.rom.source:
+            # table pointers and group sizes are read from the rom, so
+            # another rom's objects can't be reused
+            OBJECT_DICT.clear()
+            GRAND_OBJECT_DICT.clear()
+            g_table_skeletons = None
+        g_table_source = self.rom.source
+        self.columns = {}
+        self.learns, self.shops = None, None
+        self.learn_index, self.shop_index = None, None
+        set_global_table_filename(sourcefile)
+        get_learn_spells()
+        get_shops()
+        for ao in get_all_objects():
+            ao.every
+        objs = [o for ao in get_all_objects() for o in ao.every]
+        if g_table_skeletons is None:
+            g_table_skeletons = [
+                (o, dict([(k, v) for (k, v) in o.__dict__.items()
+                          if k not in o.cached_fields
+                          and k != "dirty_fields"]))
+                for o in objs if type(o) not in [LearnObject, ShopObject]]
+        else:
+            for o, skeleton in g_table_skeletons:
+                o.__dict__.clear()
+                o.__dict__.update(skeleton)
+                o.read_data()
+        for o in objs:
+            o.mark_clean()
+        self.snapshot = zip(objs, deepcopy([o.__dict__ for o in objs]))
+        self.column_snapshot = deepcopy(self.columns)
+        self.originals = dict([((type(o), o.index), state)
+                               for (o, state) in self.snapshot])
+        self.overlaps = get_overlapping_records(objs)
+
+    def reset(self):
+        if g_table_source != self.rom.source:
+            self.load(self.sourcefile)
+        self.activate()
+        self.rom.reset()
+        states = deepcopy([state for (_, state) in self.snapshot])
+        for (o, _), state in zip(self.snapshot, states):
+            o.__dict__.clear()
+            o.__dict__.update(state)
+        self.columns = deepcopy(self.column_snapshot)
+        self.clear()
+
+    @contextmanager
+    def phase(self, name):
+        if self.profiler is None:
+            yield
+        else:
+            with self.profiler.phase(name):
+                yield
+
+    def get_pool(self, processes):
+        if self.pool is None:
+            self.pool = Pool(processes=processes,
+                             initializer=init_batch_worker,
+                             initargs=(self.sourcefile, self.difficulty))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def generate(self, flags, seed, outfile=None, txtfile=None,
+                 patch=False, processes=None):
+        '''
+        With more than one process, phases that share no tables run at
+        the same time in worker sessions. The result is the same rom.
+        '''
+        self.reset()
+        if not flags.strip():
+            flags = string.lowercase
+        if outfile is None or txtfile is None:
+            outfile, txtfile = get_outfiles(self.sourcefile, seed, patch)
+        pool = None
+        if processes is not None and processes > 1:
+            pool = self.get_pool(processes)
+        randomize_tables(flags, seed, pool)
+        write_tables(seed, outfile, patch)
+        with self.phase("spoiler"):
+            write_spoiler(txtfile)
+        return outfile, txtfile
+
+
+g_table_skeletons = None
+g_table_source = None
+session = RandomizerSession()
+
+
+def randomize_treasure():
+    for d in DropObject.every:
+        d.mutate()
+    for c in ChestObject.every:
+        c.mutate()
+    for d in DresserObject.every:
+        d.mutate()
+    for m in MonsterObject.every:
+        m.mutate_treasure()
+
+
+def randomize_monsters():
+    for m in MonsterObject.every:
+        m.mutate_stats()
+    MonsterObject.shuffle_ai()
+    MonsterObject.shuffle_stats()
+    MonsterObject.get(0x80).atp = 400
+    for z in ZoneObject.every:
+        z.mutate()
+
+
+def randomize_monster_names():
+    MonsterObject.mutate_palettes()
+    MonsterObject.randomize_names()
+
+
+def randomize_shops():
+    for i in ItemObject.every:
+        i.mutate_price()
+    for s in ShopObject.every:
+        s.mutate()
+
+
+def randomize_equippability():
+    for i in ItemObject.every:
+        i.mutate_equippable()
+    for c in CharacterObject.every:
+        c.set_initial_equips()
+
+
+def randomize_character_stats():
+    for l in LevelUpObject.every:
+        l.mutate()
+    for c in CharacterObject.every:
+        c.set_initial_stats()
+
+
+def randomize_character_spells():
+    for l in LearnObject.every:
+        l.mutate()
+    fix_initial_spells()
+    set_warps_free()
+
+
+def randomize_cooking():
+    randomize_othello()
+    RecipeObject.shuffle_scores()
+
+
+# flag, name, description, function, reads, writes
+# Reads and writes name the table classes (and "ShamanCompat" and "rom")
+# whose state a phase depends on or changes, including the session state
+# listed for them in RESOURCE_SESSION_ATTRS.
+PHASES = [
+    ("f", "fusions", "fusions", randomize_fusions,
+     [], ["ShamanCompat", "ComboObject", "FusionObject"]),
+    ("t", "treasure", "treasure", randomize_treasure,
+     ["ItemObject"],
+     ["DropObject", "ChestObject", "DresserObject", "MonsterObject"]),
+    ("m", "monsters", "monsters", randomize_monsters,
+     ["FormationObject"], ["MonsterObject", "ZoneObject"]),
+    ("n", "names", "monster palettes and names", randomize_monster_names,
+     ["FormationObject", "GraphicsObject"],
+     ["MonsterObject", "PaletteObject"]),
+    ("p", "shops", "shops", randomize_shops,
+     [], ["ItemObject", "ShopObject"]),
+    ("q", "equippability", "item equippability", randomize_equippability,
+     [], ["ItemObject", "CharacterObject"]),
+    ("c", "stats", "character stats", randomize_character_stats,
+     [], ["LevelUpObject", "CharacterObject"]),
+    ("s", "spells", "character spells", randomize_character_spells,
+     ["CharacterObject"], ["LearnObject", "InitialObject", "SpellObject"]),
+    ("w", "cooking", "cooking and othello", randomize_cooking,
+     ["ItemObject"], ["RecipeObject", "rom"]),
+    ]
+RESOURCE_SESSION_ATTRS = {
+    "ShamanCompat": ["shamans", "done_affinities"],
+    "ItemObject": ["equip_dict", "newnames"],
+    "DresserObject": ["dresser_contents"],
+    "MonsterObject": ["minmax_dict"],
+    "LevelUpObject": ["levelups_shuffled"],
+    "LearnObject": ["learns_shuffled"],
+    }
+
+
+def get_phase(name):
+    return [p for p in PHASES if p[1] == name][0]
+
+
+def get_phase_state(resources):
+    state = {}
+    for name in resources:
+        if name == "rom":
+            state[name] = [(start, str(session.rom.data[start:end]))
+                           for (start, end)
+                           in session.rom.get_changed_ranges(maxgap=0)]
+            continue
+        if name in get_all_object_names():
+            ao = globals()[name]
+            state[name] = [o.__dict__ for o in ao.every]
+            state[name, "columns"] = ao.get_columns()
+        for attr in RESOURCE_SESSION_ATTRS.get(name, []):
+            state[name, attr] = getattr(session, attr)
+    return state
+
+
+def set_phase_state(state):
+    for key, value in sorted(state.items()):
+        if key == "rom":
+            for start, data in value:
+                session.rom.seek(start)
+                session.rom.write(data)
+        elif isinstance(key, tuple):
+            _, attr = key
+            if attr == "columns":
+                session.columns.update(value)
+            else:
+                setattr(session, attr, value)
+        else:
+            for o, d in zip(globals()[key].every, value):
+                o.__dict__.clear()
+                o.__dict__.update(d)
+    session.clear_caches()
+
+
+def run_phase(phase, seed):
+    flag, name, description, function, reads, writes = phase
+    with session.phase(name):
+        print "Randomizing %s." % description
+        random.seed(seed)
+        function()
+
+
+def run_phase_worker(args):
+    name, seed, difficulty, state = args
+    session.reset()
+    session.difficulty = difficulty
+    set_phase_state(state)
+    phase = get_phase(name)
+    run_phase(phase, seed)
+    _, _, _, _, reads, writes = phase
+    return get_phase_state(reads + writes)
+
+
+def phases_conflict(a, b):
+    _, _, _, _, a_reads, a_writes = a
+    _, _, _, _, b_reads, b_writes = b
+    return bool(set(a_writes) & set(b_reads + b_writes)
+                or set(b_writes) & set(a_reads))
+
+
+def get_phase_graph(phases):
+    '''
+    Map each phase name to the earlier phases it has to wait for: those
+    that write something it reads or writes, or read something it writes.
+    Phases that are not selected are not part of the graph at all.
+    '''
+    return dict((phase[1], [p[1] for p in phases[:i]
+                            if phases_conflict(p, phase)])
+                for (i, phase) in enumerate(phases))
+
+
+def run_phase_graph(phases, seed, pool):
+    '''
+    Run every phase as soon as the phases it depends on are done, sending
+    phases to the pool whenever more than one can run at once. Finished
+    phases send back only the state they declared, so results can be
+    applied in any order.
+    '''
+    graph = get_phase_graph(phases)
+    remaining = list(phases)
+    running = []
+    done = set([])
+    while remaining or running:
+        ready = [p for p in remaining if set(graph[p[1]]) <= done]
+        if len(ready) == 1 and not running:
+            run_phase(ready[0], seed)
+            remaining.remove(ready[0])
+            done.add(ready[0][1])
+            continue
+
+        for phase in ready:
+            _, name, _, _, reads, writes = phase
+            task = (name, seed, session.difficulty,
+                    get_phase_state(reads + writes))
+            running.append((name, time(),
+                            pool.apply_async(run_phase_worker, (task,))))
+            remaining.remove(phase)
+
+        while not [r for r in running if r[2].ready()]:
+            running[0][2].wait(0.01)
+        for name, start, result in [r for r in running if r[2].ready()]:
+            running.remove((name, start, result))
+            set_phase_state(result.get())
+            done.add(name)
+            if session.profiler is not None:
+                session.profiler.phases.append(
+                    {"name": name, "time": time() - start, "calls": {},
+                     "memory_change": None, "peak_memory_growth": None,
+                     "worker": True})
+
+
+def randomize_tables(flags, seed, pool=None):
+    if not RANDOMIZE:
+        return
+    phases = [p for p in PHASES if p[0] in flags]
+    if pool is None:
+        for phase in phases:
+            run_phase(phase, seed)
+    else:
+        run_phase_graph(phases, seed, pool)
+
+
+def write_tables(seed, outfile, patch=False):
+    with session.phase("write"):
+        lower_encounter_rate()
+
+        # overlapping records are all rewritten in table order whenever
+        # one of them changes, so the last writer is the same as always
+        rewrite = set([])
+        for group in session.overlaps:
+            if any([o.get_dirty_fields() for o in group]):
+                rewrite |= set([(type(o), o.index) for o in group])
+
+        special_write = [LearnObject]
+        for ao in get_all_objects():
+            if ao in special_write:
+                continue
+            for o in ao.every:
+                if ((ao, o.index) not in rewrite
+                        and not o.get_dirty_fields()):
+                    continue
+                try:
+                    o.write_data()
+                except NotImplementedError:
+                    break
+
+        ryu = CharacterObject.get(0)
+        ryu.some_index = 9
+        ryu.write_data(pointer=ryu.pointer + 0x240)
+        bow = CharacterObject.get(1)
+        bow.some_index = 0xa
+        bow.write_data(pointer=bow.pointer + 0x240)
+
+        write_learn_spells()
+        session.rom.rewrite_snes_title("BOF2-PS %s" % seed, VERSION)
+
+    with session.phase("checksum"):
+        session.rom.rewrite_snes_checksum()
+
+    with session.phase("output"):
+        if patch:
+            session.rom.write_ips(outfile)
+        else:
+            session.rom.flush(outfile)
+
+
+def write_spoiler(txtfile):
+    if TEST:
+        catobjects = sorted(get_all_objects(), key=lambda a: a.__name__)
+    else:
+        catobjects = [CharacterObject]
+
+    s = ""
+    for ao in catobjects:
+        s += ao.__name__.upper() + "\n"
+        s += ao.catalogue
+        s += "\n\n"
+
+    for scp in ShamanCompat.all_elements:
+        s += str(scp) + "\n\n"
+
+    s = s.strip()
+    f = open(txtfile, "w+")
+    f.write(s + "\n")
     f.close()
 
 
+SWITCHES = ["ips", "profile", "cprofile", "parallel"]
+
+
+def normalize_flags(flags):
+    if not set(flags) & set(string.letters):
+        flags = ""
+    if not flags.strip():
+        flags = string.lowercase
+    return flags
+
+
 def randomize():
     def display_flag_options():
         print
@@ -1487,16 +2758,16 @@ def randomize():
         print
 
     print 'You are using "Breath of Fire II: Painsong" version %s.' % VERSION
-    if len(argv) >= 2:
-        sourcefile = argv[1]
-        if len(argv) >= 3:
-            flags = argv[2]
-            if not set(flags) & set(string.letters):
-                flags = ""
-            if len(argv) >= 4:
-                seed = int(argv[3])
-                if len(argv) >= 5:
-                    set_difficulty(float(argv[4]))
+    patch = "ips" in argv
+    args = [a for a in argv if a not in SWITCHES]
+    if len(args) >= 2:
+        sourcefile = args[1]
+        if len(args) >= 3:
+            flags = args[2]
+            if len(args) >= 4:
+                seed = int(args[3])
+                if len(args) >= 5:
+                    set_difficulty(float(args[4]))
                 else:
                     set_difficulty(1.0)
             else:
@@ -1519,8 +2790,7 @@ def randomize():
             d = 1.0
         set_difficulty(d)
 
-    if not flags.strip():
-        flags = string.lowercase
+    flags = normalize_flags(flags)
 
     if seed is None or seed == "":
         seed = int(time())
@@ -1529,139 +2799,168 @@ def randomize():
     seed = seed % (10**10)
     print "Using seed: %s" % seed
 
-    outfile = sourcefile.split(".")
-    outfile = outfile[:-1] + [str(seed), outfile[-1]]
-    txtfile = ".".join(outfile[:-1] + ["txt"])
-    outfile = ".".join(outfile)
-    copyfile(sourcefile, outfile)
-    set_global_table_filename(outfile)
-    get_learn_spells(outfile)
-    get_shops(outfile)
-
-    all_objects = [g for g in globals().values()
-                   if isinstance(g, type) and issubclass(g, TableObject)
-                   and g not in [TableObject, TreasureObject]]
-    for ao in all_objects:
-        ao.every
-
-    if RANDOMIZE:
-        if 'f' in flags:
-            print "Randomizing fusions."
-            random.seed(seed)
-            randomize_fusions()
-        if 't' in flags:
-            print "Randomizing treasure."
-            random.seed(seed)
-            for d in DropObject.every:
-                d.mutate()
-            for c in ChestObject.every:
-                c.mutate()
-            for d in DresserObject.every:
-                d.mutate()
-            for m in MonsterObject.every:
-                m.mutate_treasure()
-        if 'm' in flags:
-            print "Randomizing monsters."
-            random.seed(seed)
-            for m in MonsterObject.every:
-                m.mutate_stats()
-            MonsterObject.shuffle_ai()
-            MonsterObject.shuffle_stats()
-            MonsterObject.get(0x80).atp = 400
-            for z in ZoneObject.every:
-                z.mutate()
-        if 'n' in flags:
-            print "Randomizing monster palettes and names."
-            random.seed(seed)
-            for m in MonsterObject.every:
-                m.mutate_palette()
-            MonsterObject.randomize_names()
-        if 'p' in flags:
-            print "Randomizing shops."
-            random.seed(seed)
-            for i in ItemObject.every:
-                i.mutate_price()
-            for s in ShopObject.every:
-                s.mutate()
-        if 'q' in flags:
-            print "Randomizing item equippability."
-            random.seed(seed)
-            for i in ItemObject.every:
-                i.mutate_equippable()
-            for c in CharacterObject.every:
-                c.set_initial_equips()
-        if 'c' in flags:
-            print "Randomizing character stats."
-            random.seed(seed)
-            for l in LevelUpObject.every:
-                l.mutate()
-            for c in CharacterObject.every:
-                c.set_initial_stats()
-        if 's' in flags:
-            print "Randomizing character spells."
-            random.seed(seed)
-            for l in LearnObject.every:
-                l.mutate()
-            fix_initial_spells()
-            set_warps_free()
-        if 'w' in flags:
-            print "Randomizing cooking and othello."
-            random.seed(seed)
-            randomize_othello(outfile)
-            RecipeObject.shuffle_scores()
-
-    # NO RANDOMIZATION PAST THIS LINE
-
-    lower_encounter_rate(outfile)
-
-    special_write = [LearnObject]
-    for ao in all_objects:
-        if ao in special_write:
-            continue
-        for o in ao.every:
-            try:
-                o.write_data()
-            except NotImplementedError:
-                break
+    if "profile" in argv or "cprofile" in argv:
+        session.profiler = PhaseProfiler(use_cprofile=("cprofile" in argv))
+        session.profiler.install()
+
+    with session.phase("parse"):
+        session.load(sourcefile)
+    processes = cpu_count() if "parallel" in argv else None
+    try:
+        outfile, txtfile = session.generate(flags, seed, patch=patch,
+                                            processes=processes)
+    finally:
+        session.close()
+
+    if session.profiler is not None:
+        session.profiler.uninstall()
+        session.profiler.write_report(path.splitext(txtfile)[0],
+                                      version=VERSION, flags=flags,
+                                      seed=seed, difficulty=session.difficulty,
+                                      changed=get_changed_summary())
 
-    ryu = CharacterObject.get(0)
-    ryu.some_index = 9
-    ryu.write_data(pointer=ryu.pointer + 0x240)
-    bow = CharacterObject.get(1)
-    bow.some_index = 0xa
-    bow.write_data(pointer=bow.pointer + 0x240)
+    if len(argv) < 2:
+        print
+        raw_input("Randomization completed successfully. "
+                  "Press Enter to close this program.")
 
-    write_learn_spells(outfile)
 
-    rewrite_snes_title("BOF2-PS %s" % seed, outfile, VERSION)
-    rewrite_snes_checksum(outfile)
+def init_batch_worker(sourcefile, difficulty):
+    RandomizerSession(sourcefile, difficulty=difficulty)
 
-    if TEST:
-        catobjects = sorted(all_objects, key=lambda a: a.__name__)
-    else:
-        catobjects = [CharacterObject]
 
-    s = ""
-    for ao in catobjects:
-        s += ao.__name__.upper() + "\n"
-        s += ao.catalogue
-        s += "\n\n"
+def run_batch_seed(args):
+    flags, seed, patch = args
+    outfile, txtfile = session.generate(flags, seed, patch=patch)
+    return seed, outfile, txtfile
 
-    for scp in ShamanCompat.all_elements:
-        s += str(scp) + "\n\n"
 
-    s = s.strip()
-    f = open(txtfile, "w+")
-    f.write(s + "\n")
-    f.close()
+def parse_seeds(text):
+    seeds = []
+    for part in text.split(","):
+        if "-" in part:
+            low, high = map(int, part.split("-"))
+            seeds.extend(range(low, high+1))
+        else:
+            seeds.append(int(part))
+    return seeds
 
-    if len(argv) < 2:
+
+def randomize_batch(sourcefile, flags, difficulty, seeds, processes=None,
+                    patch=False):
+    '''
+    Generate a rom and spoiler file for every seed in `seeds` using a pool
+    of worker processes, one per core by default. Each worker parses the
+    source rom once into a RandomizerSession and reuses it for every seed.
+    With `patch`, IPS patches against the source rom are written instead
+    of full roms.
+    '''
+    if isinstance(seeds, basestring):
+        seeds = parse_seeds(seeds)
+    seeds = [seed % (10**10) for seed in seeds]
+    pool = Pool(processes=processes or cpu_count(),
+                initializer=init_batch_worker,
+                initargs=(sourcefile, difficulty))
+    try:
+        results = pool.map(run_batch_seed,
+                           [(flags, seed, patch) for seed in seeds],
+                           chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def analyze_fusion_seed(seed):
+    session.reset()
+    random.seed(seed)
+    randomize_fusions()
+    fusions = []
+    for c in ComboObject.every:
+        name = CharacterObject.get(c.index).display_name
+        for index, outcome in sorted(getattr(c, "outcomes", {}).items()):
+            fusions.append((c.index, name, outcome,
+                            c.boostkinds.get(index), c.boostdict[index]))
+    return fusions
+
+
+def analyze_fusions(sourcefile, seeds, processes=None):
+    '''
+    Run only the fusion phase for every seed in `seeds` on a pool of
+    worker sessions, and tally per character how often fusions turn out
+    super, chaos, reverse or unstable along with the spread of each stat
+    boost, as percentages.
+    '''
+    if isinstance(seeds, basestring):
+        seeds = parse_seeds(seeds)
+    processes = processes or cpu_count()
+    pool = Pool(processes=processes, initializer=init_batch_worker,
+                initargs=(sourcefile, 1.0))
+    try:
+        results = pool.map(analyze_fusion_seed, seeds,
+                           chunksize=max(1, len(seeds) / (processes * 4)))
+    finally:
+        pool.close()
+        pool.join()
+
+    report = {}
+    for fusions in results:
+        for index, name, outcome, kind, boosts in fusions:
+            if index not in report:
+                report[index] = {"name": name, "fusions": 0,
+                                 "super": 0, "chaos": 0,
+                                 "reverse": 0, "unstable": 0,
+                                 "boosts": dict((a, []) for a in AFFINITIES)}
+            r = report[index]
+            r["fusions"] += 1
+            if outcome in ["super", "chaos"]:
+                r[outcome] += 1
+            if kind is not None:
+                r[kind] += 1
+            for affinity, boost in zip(AFFINITIES, boosts):
+                r["boosts"][affinity].append(int(round(boost * 100)))
+
+    for r in report.values():
+        for affinity, values in r["boosts"].items():
+            values = sorted(values)
+            r["boosts"][affinity] = {
+                "mean": sum(values) / float(len(values)),
+                "min": values[0], "max": values[-1],
+                "median": values[len(values) / 2],
+                "p90": values[int(len(values) * 0.9)]}
+    return len(seeds), report
+
+
+def print_fusion_report(numseeds, report):
+    print "Fusions over %s seeds." % numseeds
+    for index, r in sorted(report.items()):
+        n = float(r["fusions"])
         print
-        raw_input("Randomization completed successfully. "
-                  "Press Enter to close this program.")
+        print "%x %s: %.1f fusions per seed" % (index, r["name"],
+                                                n / numseeds)
+        print "  " + "  ".join(["%s %.1f%%" % (key, 100 * r[key] / n)
+                                for key in ["super", "chaos",
+                                            "reverse", "unstable"]])
+        for affinity in AFFINITIES:
+            b = r["boosts"][affinity]
+            s = "  {0:3} mean {1:5.1f} median {2:3} p90 {3:3} range {4}-{5}"
+            print s.format(affinity, b["mean"], b["median"], b["p90"],
+                           b["min"], b["max"])
+
 
 if __name__ == "__main__":
-    if "test" in argv:
+    freeze_support()
+    args = [a for a in argv if a not in SWITCHES]
+    if len(args) >= 5 and args[1] == "batch":
+        _, _, sourcefile, flags, seeds = args[:5]
+        difficulty = float(args[5]) if len(args) >= 6 else 1.0
+        for seed, outfile, txtfile in randomize_batch(
+                sourcefile, normalize_flags(flags), difficulty, seeds,
+                patch=("ips" in argv)):
+            print "%s %s" % (seed, outfile)
+    elif len(argv) >= 4 and argv[1] == "fusions":
+        print_fusion_report(*analyze_fusions(argv[2], argv[3]))
+    elif "test" in argv:
         randomize()
     else:
         try: